@@ -0,0 +1,372 @@
+from datetime import datetime
+from itertools import groupby
+
+from sqlalchemy import and_, case, func, insert, literal, select
+
+from app import db
+from models import Course, Enrollment, AttendanceSession, AttendanceRecord, AttendanceSummary
+
+# Statuses a record can be marked with
+STATUSES = ('present', 'absent', 'late')
+
+# Sessions per course in one page of a student's attendance history
+HISTORY_PAGE_SIZE = 20
+
+# Record status -> AttendanceSummary counter column
+SUMMARY_COLUMNS = {
+    'present': 'present_count',
+    'absent': 'absent_count',
+    'late': 'late_count',
+}
+
+def mark_present(session_id, student_ids, marked_by='system'):
+    """Mark students present in a session with one commit"""
+    if not student_ids:
+        return
+
+    previous = write_statuses(session_id, dict.fromkeys(student_ids, 'present'), marked_by)
+    course_id = db.session.get(AttendanceSession, session_id).course_id
+    update_summaries(course_id, [
+        (student_id, previous_status, 'present') for student_id, previous_status in previous.items()
+    ])
+    db.session.commit()
+
+def set_statuses(session_id, course_id, statuses, marked_by='manual'):
+    """Write {student_id: status} for a session, committing once.
+
+    Only students enrolled in the course are written. Returns {student_id:
+    previous status or None} for the students that were written.
+    """
+    if not statuses:
+        return {}
+
+    enrolled = db.session.scalars(select(Enrollment.student_id).where(
+        Enrollment.course_id == course_id,
+        Enrollment.student_id.in_(list(statuses))
+    )).all()
+    if not enrolled:
+        return {}
+
+    previous = write_statuses(session_id, {student_id: statuses[student_id] for student_id in enrolled}, marked_by)
+    update_summaries(course_id, [
+        (student_id, previous_status, statuses[student_id]) for student_id, previous_status in previous.items()
+    ])
+    db.session.commit()
+    return previous
+
+def write_statuses(session_id, statuses, marked_by):
+    """Write {student_id: status} records of a session and return {student_id: previous status or None}.
+
+    The summary counters are adjusted by the difference between the old
+    and new status, so the old status must be the one this write actually
+    replaced. Missing records are inserted first, and only the rows that
+    this insert created count as new. The remaining records are then read
+    with SELECT ... FOR UPDATE, which waits for any concurrent edit of the
+    same record to commit, and updated. On SQLite the first insert takes
+    the database write lock, which serializes the whole sequence.
+    """
+    marked_at = datetime.now()
+    student_ids = sorted(statuses)
+    inserted = insert_missing_records([
+        {'session_id': session_id, 'student_id': student_id, 'status': statuses[student_id],
+         'marked_by': marked_by, 'marked_at': marked_at}
+        for student_id in student_ids
+    ])
+    previous = dict.fromkeys(inserted)
+
+    existing = [student_id for student_id in student_ids if student_id not in previous]
+    if not existing:
+        return previous
+
+    # Locked in student order so concurrent batches can't deadlock each other
+    previous.update(db.session.execute(select(AttendanceRecord.student_id, AttendanceRecord.status).where(
+        AttendanceRecord.session_id == session_id,
+        AttendanceRecord.student_id.in_(existing)
+    ).order_by(AttendanceRecord.student_id).with_for_update()).all())
+
+    by_status = {}
+    for student_id in existing:
+        by_status.setdefault(statuses[student_id], []).append(student_id)
+    records = AttendanceRecord.__table__
+    for status, status_student_ids in by_status.items():
+        db.session.execute(records.update().where(
+            records.c.session_id == session_id,
+            records.c.student_id.in_(status_student_ids)
+        ).values(status=status, marked_by=marked_by, marked_at=marked_at))
+    return previous
+
+def insert_missing_records(rows):
+    """INSERT ... ON CONFLICT (session_id, student_id) DO NOTHING for attendance records.
+
+    Returns the student ids of the rows this statement inserted; rows
+    that already existed, or were inserted concurrently, are left alone.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert_missing_records_portable(rows)
+
+    statement = dialect_insert(AttendanceRecord.__table__).values(rows).on_conflict_do_nothing(
+        index_elements=['session_id', 'student_id']
+    ).returning(AttendanceRecord.__table__.c.student_id)
+    return set(db.session.scalars(statement))
+
+def insert_missing_records_portable(rows):
+    """insert_missing_records for databases without ON CONFLICT: look up the existing rows, insert the rest.
+
+    The lookup locks the rows it finds. A record inserted concurrently
+    between the lookup and the insert fails this insert with an
+    IntegrityError, which rolls the caller's transaction back.
+    """
+    records = AttendanceRecord.__table__
+    existing = set(db.session.execute(select(records.c.session_id, records.c.student_id).where(
+        records.c.session_id.in_({row['session_id'] for row in rows}),
+        records.c.student_id.in_({row['student_id'] for row in rows})
+    ).order_by(records.c.session_id, records.c.student_id).with_for_update()).all())
+
+    missing = [row for row in rows if (row['session_id'], row['student_id']) not in existing]
+    if missing:
+        db.session.execute(insert(records), missing)
+    return {row['student_id'] for row in missing}
+
+def summary_counts(course_ids=None, student_ids=None):
+    """Select each enrolled student's summary counts, computed from the attendance records"""
+    def status_count(status):
+        return func.sum(case((AttendanceRecord.status == status, 1), else_=0)).label(SUMMARY_COLUMNS[status])
+
+    record_counts = select(
+        AttendanceSession.course_id, AttendanceRecord.student_id, *map(status_count, SUMMARY_COLUMNS)
+    ).join(AttendanceSession, AttendanceSession.id == AttendanceRecord.session_id).group_by(
+        AttendanceSession.course_id, AttendanceRecord.student_id)
+    session_counts = select(
+        AttendanceSession.course_id, func.count(AttendanceSession.id).label('total_sessions')
+    ).group_by(AttendanceSession.course_id)
+
+    query = select(Enrollment.student_id, Enrollment.course_id)
+    if course_ids is not None:
+        query = query.where(Enrollment.course_id.in_(course_ids))
+        record_counts = record_counts.where(AttendanceSession.course_id.in_(course_ids))
+        session_counts = session_counts.where(AttendanceSession.course_id.in_(course_ids))
+    if student_ids is not None:
+        query = query.where(Enrollment.student_id.in_(student_ids))
+        record_counts = record_counts.where(AttendanceRecord.student_id.in_(student_ids))
+
+    record_counts = record_counts.subquery()
+    session_counts = session_counts.subquery()
+    return query.add_columns(
+        *[func.coalesce(record_counts.c[column], 0).label(column) for column in SUMMARY_COLUMNS.values()],
+        func.coalesce(session_counts.c.total_sessions, 0).label('total_sessions')
+    ).outerjoin(record_counts, and_(
+        record_counts.c.course_id == Enrollment.course_id,
+        record_counts.c.student_id == Enrollment.student_id
+    )).outerjoin(session_counts, session_counts.c.course_id == Enrollment.course_id)
+
+def bump_attendance_versions(course_ids=None):
+    """Mark cached reports of these courses (every course when None) as stale"""
+    courses = Course.__table__
+    statement = courses.update().values(attendance_version=courses.c.attendance_version + 1)
+    if course_ids is not None:
+        statement = statement.where(courses.c.id.in_(course_ids))
+    db.session.execute(statement)
+
+def refresh_summaries(course_ids=None, student_ids=None):
+    """Recompute summary rows from the attendance records (every row when no filter is given)"""
+    # The recount reads records written earlier in this transaction
+    db.session.flush()
+    bump_attendance_versions(course_ids)
+
+    summaries = AttendanceSummary.__table__
+    delete = summaries.delete()
+    if course_ids is not None:
+        delete = delete.where(summaries.c.course_id.in_(course_ids))
+    if student_ids is not None:
+        delete = delete.where(summaries.c.student_id.in_(student_ids))
+    db.session.execute(delete)
+
+    columns = ['student_id', 'course_id', *SUMMARY_COLUMNS.values(), 'total_sessions']
+    db.session.execute(insert(summaries).from_select(columns, summary_counts(course_ids, student_ids)))
+
+def update_summaries(course_id, changes):
+    """Apply (student_id, old_status, new_status) record changes to the summary counters.
+
+    Counters are adjusted in SQL so concurrent writers don't overwrite
+    each other. The old statuses must come from write_statuses, so two
+    edits of one record never both count the same old status. Students
+    without a summary row yet (enrolled before the table existed) get
+    theirs recomputed from the records instead.
+    """
+    summaries = AttendanceSummary.__table__
+    groups = {}
+    for student_id, old_status, new_status in changes:
+        if old_status != new_status:
+            groups.setdefault((old_status, new_status), []).append(student_id)
+    if groups:
+        bump_attendance_versions([course_id])
+
+    for (old_status, new_status), student_ids in groups.items():
+        values = {}
+        if old_status in SUMMARY_COLUMNS:
+            column = SUMMARY_COLUMNS[old_status]
+            values[column] = summaries.c[column] - 1
+        if new_status in SUMMARY_COLUMNS:
+            column = SUMMARY_COLUMNS[new_status]
+            values[column] = summaries.c[column] + 1
+        if not values:
+            continue
+
+        result = db.session.execute(summaries.update().where(
+            summaries.c.course_id == course_id,
+            summaries.c.student_id.in_(student_ids)
+        ).values(values))
+        if result.rowcount < len(student_ids):
+            refresh_summaries([course_id], student_ids)
+
+def open_sessions(course_ids, session_date, start_time=None):
+    """Open a session on ``session_date`` for each course, with every enrolled student absent.
+
+    Sessions are inserted in one statement and their records in one
+    INSERT ... SELECT from the enrollments, so no ORM objects are built
+    per student. Nothing is committed; the caller commits once so a
+    session never exists without its records. Returns a dict of
+    course_id -> new session id and the list of course ids skipped
+    because they already have a session that day.
+    """
+    course_ids = list(dict.fromkeys(course_ids))
+    if start_time is None:
+        start_time = datetime.now().time()
+
+    # Check which courses already have a session for this date
+    existing = {course_id for course_id, in db.session.query(AttendanceSession.course_id).filter(
+        AttendanceSession.course_id.in_(course_ids),
+        AttendanceSession.date == session_date
+    )}
+    skipped = [course_id for course_id in course_ids if course_id in existing]
+    course_ids = [course_id for course_id in course_ids if course_id not in existing]
+    if not course_ids:
+        return {}, skipped
+
+    created_at = datetime.utcnow()
+    sessions = db.session.execute(
+        insert(AttendanceSession).returning(AttendanceSession.id, AttendanceSession.course_id),
+        [{'course_id': course_id, 'date': session_date, 'start_time': start_time, 'created_at': created_at}
+         for course_id in course_ids]
+    ).all()
+    opened = {course_id: session_id for session_id, course_id in sessions}
+
+    # Initialize attendance records for all enrolled students (as absent by default)
+    records = db.session.execute(insert(AttendanceRecord.__table__).from_select(
+        ['session_id', 'student_id', 'status', 'marked_at', 'marked_by'],
+        select(
+            AttendanceSession.id, Enrollment.student_id,
+            literal('absent'), literal(created_at), literal('system')
+        ).join(Enrollment, Enrollment.course_id == AttendanceSession.course_id).where(
+            AttendanceSession.id.in_(list(opened.values())))
+    ))
+
+    add_sessions_to_summaries(course_ids, records.rowcount)
+    return opened, skipped
+
+def add_sessions_to_summaries(course_ids, record_count):
+    """Count one new session per course, each with ``record_count`` absent records in total"""
+    bump_attendance_versions(course_ids)
+    summaries = AttendanceSummary.__table__
+    result = db.session.execute(summaries.update().where(
+        summaries.c.course_id.in_(course_ids)
+    ).values(
+        total_sessions=summaries.c.total_sessions + 1,
+        absent_count=summaries.c.absent_count + 1
+    ))
+    # Every enrolled student got a record, so each should have had a summary row
+    if result.rowcount != record_count:
+        refresh_summaries(course_ids)
+
+def attendance_percentages(course_id=None, student_id=None):
+    """Attendance percentages keyed by student id (for a course) or course id (for a student).
+
+    Read from the summary table; enrollments without a summary row yet
+    are counted from the records with one grouped query.
+    """
+    query = db.session.query(Enrollment.course_id, Enrollment.student_id, AttendanceSummary).outerjoin(
+        AttendanceSummary, and_(
+            AttendanceSummary.course_id == Enrollment.course_id,
+            AttendanceSummary.student_id == Enrollment.student_id
+        ))
+    if course_id is not None:
+        query = query.filter(Enrollment.course_id == course_id)
+    if student_id is not None:
+        query = query.filter(Enrollment.student_id == student_id)
+
+    percentages = {}
+    missing = []
+    for enrolled_course_id, enrolled_student_id, summary in query:
+        if summary is None:
+            missing.append((enrolled_course_id, enrolled_student_id))
+        else:
+            key = enrolled_student_id if course_id is not None else enrolled_course_id
+            percentages[key] = summary.get_attendance_percentage()
+
+    if missing:
+        course_ids = list({missing_course_id for missing_course_id, _ in missing})
+        student_ids = list({missing_student_id for _, missing_student_id in missing})
+        for row in db.session.execute(summary_counts(course_ids, student_ids)):
+            key = row.student_id if course_id is not None else row.course_id
+            percentages[key] = AttendanceSummary(**row._mapping).get_attendance_percentage()
+    return percentages
+
+def student_history(student_id, course_id=None, before=None, limit=HISTORY_PAGE_SIZE):
+    """A page of a student's attendance history per enrolled course, newest sessions first.
+
+    One query joins the student's enrollments to their courses, each
+    course's sessions and the student's record for each session, and
+    numbers the sessions per course so only ``limit`` of them (plus one,
+    to tell whether there are more) are fetched. ``before`` is the keyset
+    of the next page: the date of the oldest session already shown, which
+    is unique within a course.
+
+    Returns one dict per course in enrollment order with the course's id,
+    name and code, its sessions as {'date', 'status'} and next_before, the
+    date to pass for the following page (None on the last page).
+    """
+    session_join = AttendanceSession.course_id == Course.id
+    if before is not None:
+        session_join = and_(session_join, AttendanceSession.date < before)
+
+    ranked = select(
+        Enrollment.id.label('enrollment_id'), Course.id.label('course_id'), Course.name, Course.code,
+        AttendanceSession.date, AttendanceRecord.status,
+        func.row_number().over(
+            partition_by=Course.id, order_by=AttendanceSession.date.desc()
+        ).label('position')
+    ).select_from(Enrollment).join(
+        Course, Course.id == Enrollment.course_id
+    ).outerjoin(
+        AttendanceSession, session_join
+    ).outerjoin(
+        AttendanceRecord, and_(
+            AttendanceRecord.session_id == AttendanceSession.id,
+            AttendanceRecord.student_id == student_id
+        )
+    ).where(Enrollment.student_id == student_id)
+    if course_id is not None:
+        ranked = ranked.where(Enrollment.course_id == course_id)
+    ranked = ranked.subquery()
+
+    rows = db.session.execute(select(ranked).where(ranked.c.position <= limit + 1).order_by(
+        ranked.c.enrollment_id, ranked.c.position))
+
+    history = []
+    for _, course_rows in groupby(rows, key=lambda row: row.enrollment_id):
+        course_rows = list(course_rows)
+        first = course_rows[0]
+        # Courses without sessions (on this page) come back as one row without a date
+        sessions = [{'date': row.date, 'status': row.status or 'N/A'}
+                    for row in course_rows[:limit] if row.date is not None]
+        history.append({
+            'course': {'id': first.course_id, 'name': first.name, 'code': first.code},
+            'sessions': sessions,
+            'next_before': sessions[-1]['date'] if len(course_rows) > limit else None
+        })
+    return history
@@ -0,0 +1,312 @@
+import os
+import sys
+import time
+import logging
+import statistics
+import subprocess
+
+import click
+from sqlalchemy import select, text
+
+from app import app, db
+from models import (User, Course, Enrollment, AttendanceSession, AttendanceRecord, AttendanceSummary,
+                    LEGACY_FACE_ENCODER)
+from face_utils import get_encoder, DETECTION_PROFILES, DETECTORS
+import attendance
+import migrations
+
+logger = logging.getLogger(__name__)
+
+@app.cli.command('db-upgrade')
+@click.option('--to', 'target', type=int, default=None, help='Stop after this migration version.')
+def db_upgrade(target):
+    """Apply pending schema migrations.
+
+    Safe to run while the app is serving: indexes are built concurrently
+    on PostgreSQL and backfills commit in small batches. Run it before
+    restarting the web workers on a new release.
+    """
+    applied = migrations.upgrade(db.engine, target)
+    with db.engine.connect() as connection:
+        version = migrations.current_version(connection)
+    if applied:
+        click.echo(f'Applied {", ".join(applied)}; schema is at version {version}')
+    else:
+        click.echo(f'Schema is up to date at version {version}')
+
+@app.cli.command('db-version')
+def db_version():
+    """Show the schema version and any pending migrations"""
+    with db.engine.connect() as connection:
+        version = migrations.current_version(connection)
+    click.echo(f'Schema version {version}, latest {migrations.latest_version()}')
+    for number, function, transactional in migrations.pending_migrations(version):
+        click.echo(f'  pending {number} {function.__name__}')
+
+# Run in a fresh interpreter: how long importing the app takes and what it loaded
+STARTUP_PROBE = '''
+import sys, time
+started = time.perf_counter()
+import main
+print((time.perf_counter() - started) * 1000, 'cv2' in sys.modules, 'numpy' in sys.modules)
+'''
+
+@app.cli.command('measure-startup')
+@click.option('--runs', default=5, show_default=True, help='Cold imports to time.')
+def measure_startup(runs):
+    """Time cold imports of the app in fresh interpreters, as a worker boot does"""
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=app.root_path,
+                                capture_output=True, text=True, check=True).stdout.split()
+        startup_ms, opencv_loaded, numpy_loaded = float(output[-3]), output[-2], output[-1]
+        timings.append(startup_ms)
+    click.echo(f'App import over {runs} runs: median {statistics.median(timings):.0f}ms, '
+               f'min {min(timings):.0f}ms, max {max(timings):.0f}ms')
+    click.echo(f'Loaded at startup: OpenCV {opencv_loaded}, numpy {numpy_loaded}')
+
+# Image files read by benchmark-detection
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def load_benchmark_images(directory):
+    """Grayscale images of a directory, as the face pipeline decodes them"""
+    import face_utils
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(directory, name), 'rb') as f:
+            img = face_utils.decode_image_bytes(f.read())
+        if img is None:
+            click.echo(f'Skipping {name}: not a readable image')
+            continue
+        images.append((name, img))
+    return images
+
+def latency_summary(timings):
+    """Median, 95th percentile and max of a list of milliseconds"""
+    p95 = statistics.quantiles(timings, n=20, method='inclusive')[-1] if len(timings) > 1 else timings[0]
+    return f'p50 {statistics.median(timings):.1f}ms, p95 {p95:.1f}ms, max {max(timings):.1f}ms'
+
+@app.cli.command('benchmark-detection')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--detector', 'backends', multiple=True, type=click.Choice(list(DETECTORS)),
+              help='Detector backend to measure, repeatable (default: all).')
+@click.option('--profile', 'profiles', multiple=True, type=click.Choice(list(DETECTION_PROFILES)),
+              help='Profile to measure, repeatable (default: all).')
+@click.option('--runs', default=3, show_default=True, help='Detections per image, backend and profile.')
+def benchmark_detection(directory, backends, profiles, runs):
+    """Compare face detector backends and profiles on a directory of images.
+
+    For each combination reports the faces found, how many images had at
+    least one, detections per second and latency percentiles. DNN
+    backends whose model files are missing are skipped.
+    """
+    import face_utils
+    images = load_benchmark_images(directory)
+    if not images:
+        click.echo(f'No images found in {directory}')
+        raise SystemExit(1)
+
+    for backend in backends or DETECTORS:
+        try:
+            detector = face_utils.create_detector(backend)
+        except Exception as e:
+            click.echo(f'{backend:<6} skipped: {str(e)}')
+            continue
+        for name in profiles or DETECTION_PROFILES:
+            profile = DETECTION_PROFILES[name]
+            timings = []
+            faces = 0
+            images_with_faces = 0
+            for _, img in images:
+                for _ in range(runs):
+                    started = time.perf_counter()
+                    found = face_utils.detect_faces(img, profile, detector)
+                    timings.append((time.perf_counter() - started) * 1000)
+                faces += len(found)
+                images_with_faces += bool(found)
+            click.echo(f'{backend:<6} {name:<9} {faces} faces, {images_with_faces}/{len(images)} images, '
+                       f'{len(timings) * 1000 / sum(timings):.1f} detections/s, {latency_summary(timings)}')
+
+@app.cli.command('reencode-faces')
+@click.option('--batch-size', default=500, show_default=True, help='Rows re-encoded per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+def reencode_faces(batch_size, pause):
+    """Re-encode legacy pixel encodings with the configured encoder.
+
+    Legacy encodings are the 100x100 grayscale face crop itself, so they
+    can be fed straight back through the current encoder without asking
+    students to register again.
+    """
+    encoder = get_encoder()
+    if encoder.name == LEGACY_FACE_ENCODER:
+        click.echo(f'Configured encoder is {LEGACY_FACE_ENCODER}, nothing to do')
+        return
+
+    last_id = 0
+    reencoded = 0
+    while True:
+        users = User.query.options(db.undefer_group('face_encoding')).filter(
+            User.id > last_id,
+            User.face_registered_filter(),
+            User.face_encoder_filter(LEGACY_FACE_ENCODER)
+        ).order_by(User.id).limit(batch_size).all()
+
+        if not users:
+            break
+
+        last_id = users[-1].id
+        for user in users:
+            pixels = user.get_face_encoding()
+            if pixels.size != 100 * 100:
+                logger.warning(f"Skipping user {user.id}: legacy encoding has {pixels.size} values")
+                continue
+            crop = pixels.astype('uint8').reshape(100, 100)
+            user.set_face_encoding(encoder.encode(crop), encoder.name)
+
+        db.session.commit()
+        db.session.expunge_all()
+
+        reencoded += len(users)
+        click.echo(f'Re-encoded {reencoded} faces with {encoder.name} (last id {last_id})')
+
+        if pause:
+            time.sleep(pause)
+
+    click.echo(f'Done, {reencoded} faces re-encoded with {encoder.name}')
+    import face_index
+    face_index.get_face_index().rebuild()
+
+@app.cli.command('rebuild-face-index')
+def rebuild_face_index():
+    """Rebuild the duplicate-check face index from the database"""
+    import face_index
+    index = face_index.get_face_index()
+    index.rebuild()
+    click.echo(f'Indexed {len(index)} faces in {len(index.centroids)} lists at {index.path}')
+
+@app.cli.command('rebuild-attendance-summary')
+@click.option('--course-id', type=int, default=None, help='Only rebuild this course.')
+def rebuild_attendance_summary(course_id):
+    """Recompute the attendance summary table from the attendance records"""
+    started = time.perf_counter()
+    attendance.refresh_summaries(None if course_id is None else [course_id])
+    db.session.commit()
+    query = AttendanceSummary.query
+    if course_id is not None:
+        query = query.filter_by(course_id=course_id)
+    click.echo(f'Rebuilt {query.count()} attendance summaries in {time.perf_counter() - started:.2f}s')
+
+@app.cli.command('verify-attendance-summary')
+@click.option('--course-id', type=int, default=None, help='Only verify this course.')
+def verify_attendance_summary(course_id):
+    """Compare the attendance summary table with counts recomputed from the records.
+
+    Exits with status 1 if any summary is missing, stale or left over from
+    a removed enrollment; run rebuild-attendance-summary to fix them.
+    """
+    counters = ['present_count', 'absent_count', 'late_count', 'total_sessions']
+    expected = {
+        (row.student_id, row.course_id): tuple(getattr(row, name) for name in counters)
+        for row in db.session.execute(attendance.summary_counts(None if course_id is None else [course_id]))
+    }
+    query = AttendanceSummary.query
+    if course_id is not None:
+        query = query.filter_by(course_id=course_id)
+    stored = {
+        (summary.student_id, summary.course_id): tuple(getattr(summary, name) for name in counters)
+        for summary in query
+    }
+
+    problems = 0
+    for key in sorted(expected.keys() | stored.keys()):
+        student_id, summary_course_id = key
+        if key not in stored:
+            click.echo(f'Missing summary for student {student_id} in course {summary_course_id}')
+        elif key not in expected:
+            click.echo(f'Summary for student {student_id} in course {summary_course_id} has no enrollment')
+        elif stored[key] != expected[key]:
+            click.echo(f'Stale summary for student {student_id} in course {summary_course_id}: '
+                       f'stored {stored[key]}, expected {expected[key]} ({", ".join(counters)})')
+        else:
+            continue
+        problems += 1
+
+    if problems:
+        click.echo(f'{problems} of {len(expected)} attendance summaries are wrong')
+        raise SystemExit(1)
+    click.echo(f'All {len(expected)} attendance summaries match the records')
+
+
+def hot_queries():
+    """(description, table that must be read through an index, statement) for the hot lookups"""
+    return [
+        ('records of a student in a course', AttendanceRecord.__tablename__,
+         select(AttendanceRecord.status).join(
+             AttendanceSession, AttendanceSession.id == AttendanceRecord.session_id
+         ).where(AttendanceRecord.student_id == 1, AttendanceSession.course_id == 1)),
+        ('records of a session', AttendanceRecord.__tablename__,
+         select(AttendanceRecord.student_id, AttendanceRecord.status).where(AttendanceRecord.session_id == 1)),
+        ('enrollments of a student', Enrollment.__tablename__,
+         select(Enrollment.course_id).where(Enrollment.student_id == 1)),
+        ('enrollments of a course', Enrollment.__tablename__,
+         select(Enrollment.student_id).where(Enrollment.course_id == 1)),
+        ('sessions of a course by date', AttendanceSession.__tablename__,
+         select(AttendanceSession.id).where(AttendanceSession.course_id == 1).order_by(
+             AttendanceSession.date.desc())),
+        ('courses of a teacher', Course.__tablename__,
+         select(Course.id).where(Course.teacher_id == 1)),
+        ('summaries of a course', AttendanceSummary.__tablename__,
+         select(AttendanceSummary.student_id).where(AttendanceSummary.course_id == 1)),
+    ]
+
+def query_plan(connection, statement):
+    """Lines of the database's plan for a statement"""
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'sqlite':
+        return [row.detail for row in connection.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+    return [row[0] for row in connection.execute(text(f'EXPLAIN {sql}'))]
+
+def is_full_scan(plan, table_name):
+    """Whether a plan reads every row of a table instead of searching an index"""
+    for line in plan:
+        if line.strip().startswith(f'Seq Scan on {table_name}'):
+            return True
+        if line.startswith(f'SCAN {table_name}'):
+            return True
+    return False
+
+@app.cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print every plan, not just failing ones.')
+def check_query_plans(verbose):
+    """Check that a usable index exists for each hot attendance lookup.
+
+    PostgreSQL picks sequential scans on small tables however good the
+    indexes are, so they are disabled while planning here: a sequential
+    scan that remains means no usable index exists. This checks a
+    deployed schema, not what the planner will choose on real data; that
+    is covered by tests/test_query_plans.py. Exits with status 1 if any
+    lookup scans its table.
+    """
+    failures = 0
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('SET LOCAL enable_seqscan = off'))
+        for description, table_name, statement in hot_queries():
+            plan = query_plan(connection, statement)
+            if is_full_scan(plan, table_name):
+                failures += 1
+                click.echo(f'FAIL {description}: {table_name} is scanned')
+            elif verbose:
+                click.echo(f'ok   {description}')
+            else:
+                continue
+            for line in plan:
+                click.echo(f'       {line}')
+        connection.rollback()
+
+    if failures:
+        click.echo(f'{failures} hot queries are not using an index, run db-upgrade')
+        raise SystemExit(1)
+    click.echo(f'All {len(hot_queries())} hot queries use an index')
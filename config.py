@@ -0,0 +1,180 @@
+import os
+import time
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Settings profile: production (default), development or test. Only development
+# and test fall back to SQLite, so a deploy missing DATABASE_URL fails to start
+APP_ENV = os.environ.get('APP_ENV', 'production')
+
+# Per-profile defaults; each can be overridden by the environment variable of the same name
+PROFILES = {
+    'development': {
+        'DB_POOL_SIZE': 5,
+        'DB_MAX_OVERFLOW': 10,
+        'DB_POOL_TIMEOUT': 30,
+        'DB_POOL_RECYCLE': 300,
+        # Milliseconds before PostgreSQL cancels a statement, 0 disables
+        'DB_STATEMENT_TIMEOUT': 0,
+        # Compiled SQL statements cached per engine
+        'DB_QUERY_CACHE_SIZE': 500,
+        # Executions before psycopg 3 prepares a statement server-side
+        'DB_PREPARE_THRESHOLD': 5,
+        # Seconds SQLite waits on a locked database
+        'DB_SQLITE_BUSY_TIMEOUT': 5,
+        'DB_ECHO': False,
+        # Apply pending schema migrations at startup instead of refusing to start
+        'DB_AUTO_MIGRATE': True,
+    },
+    'production': {
+        'DB_POOL_SIZE': 10,
+        'DB_MAX_OVERFLOW': 20,
+        'DB_POOL_TIMEOUT': 10,
+        'DB_POOL_RECYCLE': 1800,
+        'DB_STATEMENT_TIMEOUT': 30000,
+        'DB_QUERY_CACHE_SIZE': 1000,
+        'DB_PREPARE_THRESHOLD': 5,
+        'DB_SQLITE_BUSY_TIMEOUT': 5,
+        'DB_ECHO': False,
+        'DB_AUTO_MIGRATE': False,
+    },
+    'test': {
+        'DB_POOL_SIZE': 5,
+        'DB_MAX_OVERFLOW': 10,
+        'DB_POOL_TIMEOUT': 30,
+        'DB_POOL_RECYCLE': 300,
+        'DB_STATEMENT_TIMEOUT': 0,
+        'DB_QUERY_CACHE_SIZE': 500,
+        'DB_PREPARE_THRESHOLD': 5,
+        'DB_SQLITE_BUSY_TIMEOUT': 30,
+        'DB_ECHO': False,
+        'DB_AUTO_MIGRATE': True,
+    },
+}
+
+# File-backed SQLite databases used when DATABASE_URL isn't set (relative to the instance folder)
+SQLITE_FALLBACKS = {
+    'development': 'sqlite:///facetrack.db',
+    'test': 'sqlite:///facetrack-test.db',
+}
+
+def setting(name):
+    """Value of a setting for the current profile, overridden by the environment"""
+    default = PROFILES[APP_ENV][name]
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    return type(default)(value)
+
+def database_url():
+    """DATABASE_URL, or a local SQLite file when APP_ENV is development or test"""
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        # Heroku-style URLs use the scheme SQLAlchemy dropped
+        if url.startswith('postgres://'):
+            url = url.replace('postgres://', 'postgresql://', 1)
+        return url
+    if APP_ENV not in SQLITE_FALLBACKS:
+        raise RuntimeError(f'DATABASE_URL must be set when APP_ENV={APP_ENV}')
+    logger.warning(f'DATABASE_URL is not set, using {SQLITE_FALLBACKS[APP_ENV]}')
+    return SQLITE_FALLBACKS[APP_ENV]
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for a database URL under the current profile"""
+    url = make_url(url)
+    options = {
+        'pool_pre_ping': True,
+        'query_cache_size': setting('DB_QUERY_CACHE_SIZE'),
+        'echo': setting('DB_ECHO'),
+    }
+
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'timeout': setting('DB_SQLITE_BUSY_TIMEOUT')}
+        if url.database in (None, '', ':memory:'):
+            # Flask-SQLAlchemy gives in-memory databases a single shared connection
+            return options
+
+    options.update({
+        'poolclass': MeteredQueuePool,
+        'pool_size': setting('DB_POOL_SIZE'),
+        'max_overflow': setting('DB_MAX_OVERFLOW'),
+        'pool_timeout': setting('DB_POOL_TIMEOUT'),
+        'pool_recycle': setting('DB_POOL_RECYCLE'),
+    })
+
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {}
+        statement_timeout = setting('DB_STATEMENT_TIMEOUT')
+        if statement_timeout:
+            connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+        if url.get_driver_name() == 'psycopg':
+            # psycopg 3 can prepare statements server-side once they have run this many times
+            connect_args['prepare_threshold'] = setting('DB_PREPARE_THRESHOLD')
+        options['connect_args'] = connect_args
+    return options
+
+def configure_engine(engine):
+    """Per-connection settings that can't be passed as engine options"""
+    if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL lets load tests read while another worker writes
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA foreign_keys=ON')
+            cursor.close()
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a free connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait_ms = (time.perf_counter() - started) * 1000
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.wait_ms_total += wait_ms
+                self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+
+def pool_metrics(engine):
+    """Connection pool state of this process's engine"""
+    pool = engine.pool
+    metrics = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+        })
+    if isinstance(pool, MeteredQueuePool):
+        with pool._metrics_lock:
+            metrics.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_ms_avg': round(pool.wait_ms_total / pool.checkouts, 3) if pool.checkouts else 0.0,
+                'wait_ms_max': round(pool.wait_ms_max, 3),
+            })
+    return metrics
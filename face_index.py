@@ -0,0 +1,341 @@
+import os
+import fcntl
+import logging
+import threading
+import time
+
+import numpy as np
+
+from app import db
+from models import User
+from face_utils import face_distances, get_encoder
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the index snapshot and its journal of incremental changes
+INDEX_PATH = os.environ.get('FACE_ENCODINGS_PATH', 'face_encodings')
+
+# Below this many faces a single list (exact scan) is faster than clustering
+MIN_TRAIN_SIZE = 1024
+# Number of closest clusters scanned per query
+NPROBE = int(os.environ.get('FACE_INDEX_NPROBE', 8))
+# Re-cluster once the index has grown this many times past its training size
+RETRAIN_GROWTH = 4
+# Compact the journal into a new snapshot after this many entries
+MAX_JOURNAL_ENTRIES = 1000
+
+OP_ADD = 1
+OP_REMOVE = 2
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Plain Lloyd's k-means on a sample of 64 points per centroid, returns the centroids"""
+    rng = np.random.default_rng(seed)
+    sample_size = 64 * k
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids, 1)[:, 0]
+        for cluster in range(k):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return centroids
+
+def nearest_centroids(vectors, centroids, count):
+    """Indices of the ``count`` closest centroids for each vector"""
+    vectors = np.atleast_2d(vectors)
+    sq_distances = np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2 * vectors @ centroids.T
+    if count >= len(centroids):
+        return np.argsort(sq_distances, axis=1)
+    return np.argpartition(sq_distances, count, axis=1)[:, :count]
+
+class FaceIndex:
+    """IVF (inverted file) index over all registered face encodings.
+
+    Encodings are clustered with k-means and each query only scans the
+    NPROBE closest clusters. State lives in a snapshot plus an append-only
+    journal on disk, so workers share one index, pick up each other's
+    changes by replaying the journal, and startup never rebuilds it.
+    """
+
+    def __init__(self, encoder_name, dim, path=INDEX_PATH):
+        self.encoder_name = encoder_name
+        self.dim = dim
+        self.path = path
+        self.centroids = np.zeros((1, dim), dtype=np.float32)
+        self.trained_size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.count = 0
+        self.rows = {}
+        self.snapshot_stamp = None
+        self.journal_offset = 0
+        self.record = np.dtype([('op', 'i1'), ('id', '<i8'), ('vector', '<f4', (dim,))])
+        self._lock = threading.RLock()
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.path, 'snapshot.npz')
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.path, 'journal.bin')
+
+    def __len__(self):
+        return self.count
+
+    # In-memory operations
+
+    def _upsert(self, user_id, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        assignment = nearest_centroids(vector, self.centroids, 1)[0, 0]
+        row = self.rows.get(user_id)
+        if row is None:
+            if self.count == len(self.ids):
+                # Grow buffers geometrically so appends are amortized O(dim)
+                capacity = max(64, 2 * len(self.ids))
+                self.ids = np.resize(self.ids, capacity)
+                self.assignments = np.resize(self.assignments, capacity)
+                vectors = np.empty((capacity, self.dim), dtype=np.float32)
+                vectors[:self.count] = self.vectors[:self.count]
+                self.vectors = vectors
+            row = self.count
+            self.count += 1
+            self.rows[user_id] = row
+        self.ids[row] = user_id
+        self.vectors[row] = vector
+        self.assignments[row] = assignment
+
+    def _remove(self, user_id):
+        row = self.rows.pop(user_id, None)
+        if row is None:
+            return
+        # Move the last row into the hole to keep the buffers dense
+        last = self.count - 1
+        if row != last:
+            moved_id = int(self.ids[last])
+            self.ids[row] = moved_id
+            self.vectors[row] = self.vectors[last]
+            self.assignments[row] = self.assignments[last]
+            self.rows[moved_id] = row
+        self.count = last
+
+    def _train(self):
+        vectors = self.vectors[:self.count]
+        if self.count >= MIN_TRAIN_SIZE:
+            nlist = int(np.sqrt(self.count))
+            self.centroids = kmeans(vectors, nlist).astype(np.float32)
+        else:
+            self.centroids = np.zeros((1, self.dim), dtype=np.float32)
+        self.assignments[:self.count] = nearest_centroids(vectors, self.centroids, 1)[:, 0] if self.count else []
+        self.trained_size = self.count
+
+    def search(self, encoding, exclude_id=None):
+        """Return (user_id, distance) of the closest indexed face, or (None, None)"""
+        with self._lock:
+            self.sync()
+            if self.count == 0:
+                return None, None
+
+            probe = np.asarray(encoding, dtype=np.float32).ravel()
+            lists = nearest_centroids(probe, self.centroids, NPROBE)[0]
+            candidates = np.flatnonzero(np.isin(self.assignments[:self.count], lists))
+            if exclude_id is not None:
+                candidates = candidates[self.ids[candidates] != exclude_id]
+            if len(candidates) == 0:
+                return None, None
+
+            distances = face_distances(self.vectors[candidates], probe)
+            best = int(np.argmin(distances))
+            return int(self.ids[candidates[best]]), float(distances[best])
+
+    # Persistence
+
+    def _file_stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load_snapshot(self):
+        with np.load(self.snapshot_file) as snapshot:
+            if str(snapshot['encoder_name']) != self.encoder_name:
+                return False
+            self.centroids = snapshot['centroids']
+            self.trained_size = int(snapshot['trained_size'])
+            self.ids = snapshot['ids']
+            self.vectors = snapshot['vectors']
+            self.assignments = snapshot['assignments']
+        self.count = len(self.ids)
+        self.rows = {int(user_id): row for row, user_id in enumerate(self.ids)}
+        self.journal_offset = 0
+        return True
+
+    def sync(self):
+        """Pick up a newer snapshot and replay journal entries written by other workers.
+
+        Holds the shared file lock so a writer can't compact the journal
+        between reading the snapshot and replaying the journal, which
+        would leave a stale offset and skip the entries appended after.
+        """
+        with self._lock:
+            lock_file = self._locked(fcntl.LOCK_SH)
+            try:
+                return self._replay()
+            finally:
+                lock_file.close()
+
+    def _replay(self):
+        """sync() for callers already holding the file lock"""
+        with self._lock:
+            stamp = self._file_stamp(self.snapshot_file)
+            if stamp is None:
+                return False
+            if stamp != self.snapshot_stamp:
+                if not self._load_snapshot():
+                    return False
+                self.snapshot_stamp = stamp
+
+            try:
+                journal_size = os.path.getsize(self.journal_file)
+            except FileNotFoundError:
+                journal_size = 0
+            if journal_size < self.journal_offset:
+                # Journal was compacted into a snapshot we haven't seen yet
+                self.snapshot_stamp = None
+                return self._replay()
+            if journal_size > self.journal_offset:
+                with open(self.journal_file, 'rb') as journal:
+                    journal.seek(self.journal_offset)
+                    data = journal.read(journal_size - self.journal_offset)
+                complete = len(data) - len(data) % self.record.itemsize
+                for entry in np.frombuffer(data[:complete], dtype=self.record):
+                    if entry['op'] == OP_ADD:
+                        self._upsert(int(entry['id']), entry['vector'])
+                    else:
+                        self._remove(int(entry['id']))
+                self.journal_offset += complete
+            return True
+
+    def _write_snapshot(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = self.snapshot_file + '.tmp.npz'
+        np.savez(tmp_file,
+                 encoder_name=np.array(self.encoder_name),
+                 centroids=self.centroids,
+                 trained_size=np.array(self.trained_size),
+                 ids=self.ids[:self.count],
+                 vectors=self.vectors[:self.count],
+                 assignments=self.assignments[:self.count])
+        os.replace(tmp_file, self.snapshot_file)
+        # Replaying entries already in the snapshot is harmless, so truncate after replacing
+        open(self.journal_file, 'wb').close()
+        self.snapshot_stamp = self._file_stamp(self.snapshot_file)
+        self.journal_offset = 0
+
+    def _locked(self, operation=fcntl.LOCK_EX):
+        """Take the index's file lock: exclusive for writers, LOCK_SH for readers"""
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, '.lock'), 'a')
+        fcntl.flock(lock_file, operation)
+        return lock_file
+
+    def _append(self, op, user_id, vector=None):
+        """Apply a change and append it to the shared journal"""
+        with self._lock:
+            lock_file = self._locked()
+            try:
+                self._replay()
+                entry = np.zeros(1, dtype=self.record)
+                entry['op'] = op
+                entry['id'] = user_id
+                if vector is not None:
+                    entry['vector'] = np.asarray(vector, dtype=np.float32).ravel()
+                with open(self.journal_file, 'ab') as journal:
+                    journal.write(entry.tobytes())
+                self.journal_offset += self.record.itemsize
+
+                if op == OP_ADD:
+                    self._upsert(user_id, vector)
+                else:
+                    self._remove(user_id)
+
+                if self.count >= MIN_TRAIN_SIZE and self.count > RETRAIN_GROWTH * max(self.trained_size, 1):
+                    self._train()
+                    self._write_snapshot()
+                elif self.journal_offset > MAX_JOURNAL_ENTRIES * self.record.itemsize:
+                    self._write_snapshot()
+            finally:
+                lock_file.close()
+
+    def add(self, user_id, encoding):
+        self._append(OP_ADD, user_id, encoding)
+
+    def remove(self, user_id):
+        self._append(OP_REMOVE, user_id)
+
+    def rebuild(self, batch_size=1000):
+        """Rebuild the index from every registered encoding in the database"""
+        with self._lock:
+            lock_file = self._locked()
+            try:
+                started = time.perf_counter()
+                self.ids = np.empty(0, dtype=np.int64)
+                self.vectors = np.empty((0, self.dim), dtype=np.float32)
+                self.assignments = np.empty(0, dtype=np.int32)
+                self.count = 0
+                self.rows = {}
+                self.centroids = np.zeros((1, self.dim), dtype=np.float32)
+
+                query = db.session.query(
+                    User.id, User.face_encoding_data, User.face_encoding_dtype,
+                    User.face_encoding_dim, User.face_encoding
+                ).filter(
+                    User.face_registered_filter(),
+                    User.face_encoder_filter(self.encoder_name)
+                ).order_by(User.id)
+                for user_id, data, dtype, dim, legacy_json in query.yield_per(batch_size):
+                    encoding = User.decode_face_encoding(data, dtype, dim, legacy_json)
+                    if encoding.size == self.dim:
+                        self._upsert(user_id, encoding)
+
+                self._train()
+                self._write_snapshot()
+                logger.info(f"Built face index with {self.count} faces and {len(self.centroids)} lists "
+                            f"in {time.perf_counter() - started:.2f}s")
+            finally:
+                lock_file.close()
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_face_index():
+    """Return the process-wide face index, loading it from disk or building it once"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            encoder = get_encoder()
+            index = FaceIndex(encoder.name, encoder.dim)
+            if not index.sync():
+                index.rebuild()
+            _index = index
+        return _index
+
+def is_duplicate_face(encoding, exclude_id=None, tolerance=None):
+    """Check whether a face is already registered by another user.
+
+    Without a tolerance, faces are only rejected when the encoder's own
+    is calibrated: a guessed one turns away different students as duplicates.
+    """
+    if encoding is None:
+        return False
+    if tolerance is None:
+        encoder = get_encoder()
+        if not encoder.calibrated:
+            return False
+        tolerance = encoder.tolerance
+    user_id, distance = get_face_index().search(encoding, exclude_id)
+    return user_id is not None and distance < tolerance
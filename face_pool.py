@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, BrokenExecutor
+
+logger = logging.getLogger(__name__)
+
+# 'process' (default), 'thread', or 'inline' to run in the calling thread
+POOL_MODE = os.environ.get('FACE_POOL_MODE', 'process')
+POOL_WORKERS = int(os.environ.get('FACE_POOL_WORKERS', 2))
+# Jobs allowed to be queued or running at once before callers get a 429
+POOL_MAX_PENDING = int(os.environ.get('FACE_POOL_MAX_PENDING', POOL_WORKERS * 4))
+POOL_TIMEOUT = float(os.environ.get('FACE_POOL_TIMEOUT', 10))
+# Suggested client back-off when the pool is saturated
+RETRY_AFTER = int(os.environ.get('FACE_POOL_RETRY_AFTER', 1))
+
+class PoolSaturated(Exception):
+    """Raised when the face pool already has the maximum number of pending jobs"""
+
+    def __init__(self, retry_after=RETRY_AFTER):
+        super().__init__(f'Face processing pool is busy, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+def _init_worker():
+    """Load OpenCV, the face detector and the encoder once per worker process"""
+    import face_utils
+    face_utils.preload()
+
+def _timed(fn, args):
+    """Run a job in the worker and report how long it took there"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+class FacePool:
+    """Bounded executor for CPU-heavy face detection and encoding.
+
+    Jobs run off the request thread (in worker processes by default). At
+    most ``max_pending`` jobs may be queued or running; beyond that
+    ``submit`` fails fast with PoolSaturated instead of letting requests
+    pile up behind a busy pool. If a worker dies (e.g. OOM-killed) the
+    broken executor is replaced so later jobs run on fresh workers.
+    """
+
+    def __init__(self, mode=POOL_MODE, workers=POOL_WORKERS, max_pending=POOL_MAX_PENDING):
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor_lock = threading.Lock()
+        self._executor = self._start_executor()
+
+    def _start_executor(self):
+        if self.mode == 'process':
+            # spawn keeps workers independent of the parent's threads and DB connections
+            context = multiprocessing.get_context(os.environ.get('FACE_POOL_START_METHOD', 'spawn'))
+            return ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker)
+        if self.mode == 'thread':
+            return ThreadPoolExecutor(self.workers, thread_name_prefix='face-pool', initializer=_init_worker)
+        return None
+
+    def _restart(self, broken):
+        """Replace a broken executor, unless another caller already has"""
+        with self._executor_lock:
+            if broken is None or self._executor is not broken:
+                return
+            logger.error(f"Face pool is broken, restarting {self.workers} workers")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start_executor()
+
+    def submit(self, fn, *args):
+        """Queue a job, returning a future resolving to (result, worker_ms)"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated()
+
+        executor = self._executor
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(_timed(fn, args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            try:
+                try:
+                    future = executor.submit(_timed, fn, args)
+                except BrokenExecutor:
+                    # A worker died since the last job; retry once on fresh workers
+                    self._restart(executor)
+                    executor = self._executor
+                    future = executor.submit(_timed, fn, args)
+            except Exception:
+                self._slots.release()
+                raise
+        # Remembered so run() knows which executor to replace if this job breaks it
+        future.executor = executor
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args, timeout=POOL_TIMEOUT):
+        """Run a job and wait for it, adding the time spent queued to its timings.
+
+        Raises BrokenExecutor if a worker died while running the job; the
+        pool is restarted so the caller can simply retry.
+        """
+        started = time.perf_counter()
+        future = self.submit(fn, *args)
+        try:
+            result, worker_ms = future.result(timeout=timeout)
+        except BrokenExecutor:
+            self._restart(future.executor)
+            raise
+        if isinstance(result, dict) and 'timings' in result:
+            total_ms = (time.perf_counter() - started) * 1000
+            result['timings']['queue_ms'] = round(max(total_ms - worker_ms, 0), 2)
+        return result
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_face_pool():
+    """Return this process's face pool, created on first use so forked workers each get their own"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FacePool()
+            logger.info(f"Started face pool ({_pool.mode}, {_pool.workers} workers, "
+                        f"{_pool.max_pending} max pending)")
+        return _pool
@@ -1,86 +1,573 @@
+import os
+import time
 import logging
 import base64
+import math
 import json
-import numpy as np
-import cv2
+import threading
 from io import BytesIO
 
+# OpenCV and numpy are imported where they are used, so importing this
+# module (and the app) doesn't pay for them until a face is processed
+
 logger = logging.getLogger(__name__)
 
-# Load OpenCV face detector
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+# Guards the one-time loading of the detector and encoder
+_load_lock = threading.Lock()
+_face_detector = None
+
+# Milliseconds this process spent loading each face model, reported by /metrics/startup
+load_times = {}
+
+class FaceDetector:
+    """Finds faces in a grayscale image.
+
+    Subclasses set ``name`` and implement ``detect``, returning a list of
+    ((x, y, w, h), confidence). Confidences are only comparable between
+    results of the same backend.
+    """
+    name = None
+
+    def detect(self, img, min_size, max_size, scale_factor=1.1, min_neighbors=4):
+        """Faces between min_size and max_size pixels wide; scale_factor and
+        min_neighbors only apply to the Haar cascade"""
+        raise NotImplementedError
+
+class HaarDetector(FaceDetector):
+    """OpenCV's frontal face Haar cascade; confidence is the cascade's final stage weight"""
+    name = 'haar'
+
+    def __init__(self, cascade_path=None):
+        import cv2
+        self.cascade = cv2.CascadeClassifier(
+            cascade_path or cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        if self.cascade.empty():
+            raise RuntimeError('Could not load the Haar cascade face detector')
+
+    def detect(self, img, min_size, max_size, scale_factor=1.1, min_neighbors=4):
+        faces, _, weights = self.cascade.detectMultiScale3(
+            img, scale_factor, min_neighbors, minSize=(min_size, min_size), maxSize=(max_size, max_size),
+            outputRejectLevels=True)
+        return [((int(x), int(y), int(w), int(h)), float(weight)) for (x, y, w, h), weight in zip(faces, weights)]
+
+def require_files(*paths):
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'Model file {path} not found')
+
+def clamp_box(left, top, right, bottom, width, height):
+    """Clip a box given by its corners to a width x height image.
+
+    DNN detectors return boxes reaching past the frame for faces at its
+    edge. Returns (x, y, w, h), or None if nothing of the box is inside.
+    """
+    x, y = max(int(left), 0), max(int(top), 0)
+    w, h = min(int(right), width) - x, min(int(bottom), height) - y
+    if w <= 0 or h <= 0:
+        return None
+    return x, y, w, h
+
+def within_size(faces, min_size, max_size):
+    """Keep the faces whose width is between min_size and max_size"""
+    return [(box, confidence) for box, confidence in faces if min_size <= box[2] <= max_size]
+
+class YuNetDetector(FaceDetector):
+    """OpenCV's YuNet CNN detector (face_detection_yunet_2023mar.onnx); confidence is its 0-1 score"""
+    name = 'yunet'
+    confidence_threshold = 0.8
 
-def preprocess_base64_image(base64_string):
-    """Convert base64 image to numpy array for face detection"""
+    def __init__(self, model_path, confidence_threshold=None):
+        import cv2
+        require_files(model_path)
+        self.confidence_threshold = confidence_threshold or self.confidence_threshold
+        self.model = cv2.FaceDetectorYN.create(model_path, '', (320, 320), self.confidence_threshold)
+
+    def detect(self, img, min_size, max_size, scale_factor=1.1, min_neighbors=4):
+        import cv2
+        height, width = img.shape[:2]
+        self.model.setInputSize((width, height))
+        _, faces = self.model.detect(cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))
+        if faces is None:
+            return []
+        boxes = []
+        # Each row is the box, five landmarks and the score
+        for face in faces:
+            box = clamp_box(face[0], face[1], face[0] + face[2], face[1] + face[3], width, height)
+            if box is not None:
+                boxes.append((box, float(face[-1])))
+        return within_size(boxes, min_size, max_size)
+
+class SSDDetector(FaceDetector):
+    """OpenCV's res10 300x300 SSD (Caffe model plus deploy.prototxt); confidence is its 0-1 score"""
+    name = 'ssd'
+    confidence_threshold = 0.5
+    input_size = 300
+
+    def __init__(self, model_path, config_path, confidence_threshold=None):
+        import cv2
+        require_files(model_path, config_path)
+        self.net = cv2.dnn.readNetFromCaffe(config_path, model_path)
+        self.confidence_threshold = confidence_threshold or self.confidence_threshold
+
+    def detect(self, img, min_size, max_size, scale_factor=1.1, min_neighbors=4):
+        import cv2
+        height, width = img.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), 1.0,
+                                     (self.input_size, self.input_size), (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        faces = []
+        # Rows are (image, class, confidence, left, top, right, bottom) with coordinates in 0-1
+        for _, _, confidence, left, top, right, bottom in self.net.forward()[0, 0]:
+            if confidence < self.confidence_threshold:
+                continue
+            box = clamp_box(left * width, top * height, right * width, bottom * height, width, height)
+            if box is not None:
+                faces.append((box, float(confidence)))
+        return within_size(faces, min_size, max_size)
+
+DETECTORS = {
+    'haar': HaarDetector,
+    'yunet': YuNetDetector,
+    'ssd': SSDDetector,
+}
+
+def create_detector(backend):
+    """Build a detector backend from its FACE_DETECTOR_* settings, raising if its model can't be loaded"""
+    threshold = float(os.environ.get('FACE_DETECTOR_CONFIDENCE', 0)) or None
+    if backend == 'yunet':
+        return YuNetDetector(os.environ.get('FACE_DETECTOR_MODEL', 'face_models/face_detection_yunet_2023mar.onnx'),
+                             threshold)
+    if backend == 'ssd':
+        return SSDDetector(os.environ.get('FACE_DETECTOR_MODEL', 'face_models/res10_300x300_ssd_iter_140000.caffemodel'),
+                           os.environ.get('FACE_DETECTOR_CONFIG', 'face_models/deploy.prototxt'),
+                           threshold)
+    return HaarDetector()
+
+def get_face_detector():
+    """Return the detector selected by FACE_DETECTOR (haar, yunet or ssd), loaded on first use and shared by the process"""
+    global _face_detector
+    if _face_detector is None:
+        with _load_lock:
+            if _face_detector is None:
+                _face_detector = load_detector()
+    return _face_detector
+
+def load_detector():
+    """Build the configured detector, falling back to the Haar cascade if its model can't be loaded"""
+    started = time.perf_counter()
+    backend = os.environ.get('FACE_DETECTOR', 'haar')
+    if backend not in DETECTORS:
+        logger.warning(f"Unknown face detector {backend}, using haar")
+        backend = 'haar'
     try:
-        # Remove data URL prefix if present
-        if "base64," in base64_string:
-            base64_string = base64_string.split("base64,")[1]
-        
-        # Decode base64 image
-        img_data = base64.b64decode(base64_string)
+        detector = create_detector(backend)
+    except Exception as e:
+        if backend == 'haar':
+            raise
+        logger.error(f"Could not load {backend} face detector: {str(e)}, using Haar cascade")
+        detector = HaarDetector()
+    load_times['detector_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Using face detector {detector.name}, loaded in {load_times['detector_ms']}ms")
+    return detector
+
+# Detection profiles. Frames are downscaled to at most working_width pixels
+# before the cascade runs, and only faces between min_face and max_face of
+# the working width are searched for; boxes are mapped back to the full
+# image for encoding. scale_factor and min_neighbors only apply to the Haar cascade.
+DETECTION_PROFILES = {
+    'fast': {'working_width': 320, 'scale_factor': 1.2, 'min_neighbors': 4, 'min_face': 0.1, 'max_face': 0.6},
+    'balanced': {'working_width': 640, 'scale_factor': 1.1, 'min_neighbors': 4, 'min_face': 0.05, 'max_face': 0.8},
+    'accurate': {'working_width': 1280, 'scale_factor': 1.05, 'min_neighbors': 5, 'min_face': 0.02, 'max_face': 1.0},
+}
+
+def load_detection_profile():
+    """The FACE_DETECTION_PROFILE profile, with FACE_DETECTION_<SETTING> environment overrides applied"""
+    name = os.environ.get('FACE_DETECTION_PROFILE', 'balanced')
+    if name not in DETECTION_PROFILES:
+        logger.warning(f"Unknown face detection profile {name}, using balanced")
+        name = 'balanced'
+    profile = dict(DETECTION_PROFILES[name])
+    for key, default in DETECTION_PROFILES[name].items():
+        variable = f'FACE_DETECTION_{key.upper()}'
+        value = os.environ.get(variable)
+        if not value:
+            continue
+        # Parsed as a float first so e.g. 640.0 is accepted for an integer setting
+        try:
+            number = float(value)
+            if not math.isfinite(number):
+                raise ValueError(f'{value} is not a finite number')
+            if isinstance(default, int):
+                if not number.is_integer():
+                    raise ValueError(f'{value} is not a whole number')
+                number = int(number)
+        except ValueError as e:
+            logger.warning(f"Ignoring {variable}={value}, using {default}: {str(e)}")
+            continue
+        profile[key] = number
+    return profile
+
+# Detection settings used unless a caller passes its own profile
+DETECTION_PROFILE = load_detection_profile()
+
+class FaceEncoder:
+    """Turns a cropped grayscale face into a fixed-length feature vector.
+
+    Subclasses set ``name`` (stored next to every encoding so vectors from
+    different encoders are never compared), ``dim``, ``normalized`` (unit
+    vectors compared by cosine distance instead of Euclidean distance) and
+    the default match ``tolerance``. ``calibrated`` is set when that
+    tolerance has been checked against real faces (or FACE_RECOGNITION_THRESHOLD
+    overrides it); duplicate registrations are only rejected then.
+    """
+    name = None
+    dim = None
+    normalized = False
+    tolerance = None
+    calibrated = False
+
+    def encode(self, face_region):
+        raise NotImplementedError
+
+class PixelEncoder(FaceEncoder):
+    """Legacy encoder: the raw 100x100 crop flattened to 10,000 values"""
+    name = 'pixel-v1'
+    dim = 100 * 100
+    tolerance = 5000
+    calibrated = True
+
+    def encode(self, face_region):
+        import cv2
+        return cv2.resize(face_region, (100, 100)).flatten()
+
+def lbp_riu2_labels():
+    """Rotation-invariant uniform LBP labels: bit count for patterns with at most
+    two 0/1 transitions, a single shared label (9) for everything else"""
+    import numpy as np
+    return np.array([
+        bin(code).count('1') if bin(code ^ ((code >> 1) | ((code & 1) << 7))).count('1') <= 2 else 9
+        for code in range(256)
+    ], dtype=np.uint8)
+
+class LBPEncoder(FaceEncoder):
+    """Spatial histogram of local binary patterns (7x7 grid x 10 labels = 490 dims).
+
+    Histogram equalization plus LBP's ordinal comparisons make the
+    descriptor largely insensitive to lighting changes.
+    """
+    name = 'lbp-v1'
+    grid = 7
+    size = 100
+    dim = grid * grid * 10
+    normalized = True
+    tolerance = 0.15
+
+    def __init__(self):
+        self.labels = lbp_riu2_labels()
+
+    def encode(self, face_region):
+        import cv2
+        import numpy as np
+        face = cv2.equalizeHist(cv2.resize(face_region, (self.size, self.size))).astype(np.int16)
+        center = face[1:-1, 1:-1]
+        height, width = center.shape
+
+        # Compare each pixel with its 8 neighbours, walking around the circle
+        codes = np.zeros(center.shape, dtype=np.uint8)
+        offsets = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+        for bit, (dy, dx) in enumerate(offsets):
+            neighbour = face[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+            codes |= (neighbour >= center).astype(np.uint8) << bit
+        labels = self.labels[codes]
+
+        # One histogram per grid cell, computed with a single bincount
+        rows = np.arange(height) * self.grid // height
+        cols = np.arange(width) * self.grid // width
+        cells = rows[:, None] * self.grid + cols[None, :]
+        histogram = np.bincount((cells * 10 + labels).ravel(), minlength=self.dim).astype(np.float32)
+
+        # Hellinger mapping then L2 normalization so cosine similarity is a dot product
+        histogram = np.sqrt(histogram)
+        return histogram / max(np.linalg.norm(histogram), 1e-6)
+
+class DNNEncoder(FaceEncoder):
+    """Embedding from a local OpenCV DNN model (e.g. OpenFace nn4.small2.v1.t7, 128 dims)"""
+    normalized = True
+    tolerance = 0.4
+
+    def __init__(self, model_path, input_size=96):
+        import cv2
+        import numpy as np
+        self.net = cv2.dnn.readNet(model_path)
+        self.input_size = input_size
+        self.name = DNNEncoder.model_name(model_path)
+        # The embedding size depends on the model, so run it once to find out
+        self.dim = self.encode(np.zeros((self.input_size, self.input_size), dtype=np.uint8)).size
+
+    @staticmethod
+    def model_name(model_path):
+        """Encoder name recorded for encodings from this model file"""
+        return f'dnn-{os.path.splitext(os.path.basename(model_path))[0]}-v1'
+
+    def encode(self, face_region):
+        import cv2
+        import numpy as np
+        face = cv2.cvtColor(face_region, cv2.COLOR_GRAY2BGR) if face_region.ndim == 2 else face_region
+        blob = cv2.dnn.blobFromImage(face, 1.0 / 255, (self.input_size, self.input_size),
+                                     (0, 0, 0), swapRB=True, crop=False)
+        self.net.setInput(blob)
+        embedding = self.net.forward().flatten().astype(np.float32)
+        return embedding / max(np.linalg.norm(embedding), 1e-6)
+
+# Embedding model loaded by FACE_ENCODER=dnn unless FACE_ENCODER_MODEL names another
+DNN_ENCODER_MODEL = 'face_models/nn4.small2.v1.t7'
+
+ENCODERS = {
+    'pixel': PixelEncoder,
+    'lbp': LBPEncoder,
+    'dnn': DNNEncoder,
+}
+
+_encoder = None
+
+def get_encoder():
+    """Return the encoder selected by FACE_ENCODER (lbp, pixel or dnn), created on first use and shared by the process"""
+    global _encoder
+    if _encoder is None:
+        with _load_lock:
+            if _encoder is None:
+                _encoder = load_encoder()
+    return _encoder
+
+def configured_encoder_name():
+    """Name of the encoder FACE_ENCODER selects, worked out without loading it"""
+    backend = os.environ.get('FACE_ENCODER', 'lbp')
+    if backend == 'dnn':
+        model_path = os.environ.get('FACE_ENCODER_MODEL', DNN_ENCODER_MODEL)
+        # load_encoder falls back to LBP without the model file
+        return DNNEncoder.model_name(model_path) if os.path.exists(model_path) else LBPEncoder.name
+    return ENCODERS.get(backend, LBPEncoder).name
+
+def load_encoder():
+    """Build the encoder configured by FACE_ENCODER and FACE_RECOGNITION_THRESHOLD"""
+    started = time.perf_counter()
+    backend = os.environ.get('FACE_ENCODER', 'lbp')
+    if backend == 'dnn':
+        model_path = os.environ.get('FACE_ENCODER_MODEL', DNN_ENCODER_MODEL)
+        try:
+            encoder = DNNEncoder(model_path)
+        except Exception as e:
+            logger.error(f"Could not load face embedding model {model_path}: {str(e)}, using LBP encoder")
+            encoder = LBPEncoder()
+    else:
+        encoder = ENCODERS.get(backend, LBPEncoder)()
+    threshold = os.environ.get('FACE_RECOGNITION_THRESHOLD')
+    if threshold:
+        encoder.tolerance = float(threshold)
+        encoder.calibrated = True
+    elif not encoder.calibrated:
+        logger.warning(f"Matching {encoder.name} faces with its default tolerance {encoder.tolerance}, which has not "
+                       f"been calibrated on real faces, and not rejecting duplicate registrations; set "
+                       f"FACE_RECOGNITION_THRESHOLD for this deployment")
+    load_times['encoder_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Using face encoder {encoder.name}, loaded in {load_times['encoder_ms']}ms")
+    return encoder
+
+def preload():
+    """Load the face detector and encoder now instead of on first use"""
+    get_face_detector()
+    get_encoder()
+
+def after_fork():
+    """Reset state a forked child must not share with its parent.
+
+    The cascade is plain data and stays shared copy-on-write. DNN
+    detectors and encoders are rebuilt on first use because OpenCV's DNN
+    backends keep per-process thread pools, and the lock may have been
+    held by another thread when the process forked.
+    """
+    global _load_lock, _face_detector, _encoder
+    _load_lock = threading.Lock()
+    if _face_detector is not None and not isinstance(_face_detector, HaarDetector):
+        _face_detector = None
+    if isinstance(_encoder, DNNEncoder):
+        _encoder = None
+
+def decode_image_bytes(img_data, reduced=False):
+    """Decode encoded image bytes (JPEG, PNG, ...) straight to a grayscale numpy array.
+
+    With ``reduced`` the decoder produces a half-resolution image directly,
+    which is much cheaper for large frames; box coordinates found on it
+    must be scaled by 2 to map back to the original frame.
+    """
+    import cv2
+    import numpy as np
+    try:
+        # Wrap the bytes without copying them
         img_array = np.frombuffer(img_data, dtype=np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-        
-        # Convert to grayscale for face detection
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        return gray
+        flags = cv2.IMREAD_REDUCED_GRAYSCALE_2 if reduced else cv2.IMREAD_GRAYSCALE
+        return cv2.imdecode(img_array, flags)
     except Exception as e:
-        logger.error(f"Error processing base64 image: {str(e)}")
+        logger.error(f"Error decoding image: {str(e)}")
         return None
 
-def extract_face_encoding(image_data):
-    """Extract face features from image data (either base64 string or numpy array)"""
+def decode_base64_image(base64_string):
+    """Decode a base64 image or data URL to its encoded bytes, or None if it is not valid base64"""
+    # Remove data URL prefix if present
+    if "base64," in base64_string:
+        base64_string = base64_string.split("base64,")[1]
     try:
-        # If image_data is a base64 string, preprocess it
-        if isinstance(image_data, str):
-            img = preprocess_base64_image(image_data)
-        else:
-            img = image_data
-            
-        if img is None:
-            logger.error("Failed to preprocess image")
-            return None
-            
-        # Detect faces
-        faces = face_cascade.detectMultiScale(img, 1.1, 4)
-        
-        if len(faces) == 0:
-            logger.warning("No faces detected in the image")
-            return None
-            
-        # Get the largest face (assuming it's the most prominent one)
-        largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
-        x, y, w, h = largest_face
-        
-        # Extract face region
-        face_region = img[y:y+h, x:x+w]
-        
-        # Resize to a standard size for consistency
-        face_resized = cv2.resize(face_region, (100, 100))
-        
-        # Flatten the face image to create a feature vector
-        face_encoding = face_resized.flatten().tolist()
-        
-        return face_encoding
-    except Exception as e:
-        logger.error(f"Error extracting face encoding: {str(e)}")
+        return base64.b64decode(base64_string)
+    except ValueError:
         return None
 
-def compare_faces(known_encoding, unknown_encoding, tolerance=5000):
+def detect_faces(img, profile=None, detector=None):
+    """Detect faces on a downscaled copy of a grayscale image.
+
+    The image is shrunk to the profile's working width (never enlarged)
+    and only the profile's range of face sizes is searched. Returns a list
+    of ((x, y, w, h), confidence) with boxes in ``img`` coordinates.
+    """
+    import cv2
+    profile = profile or DETECTION_PROFILE
+    detector = detector or get_face_detector()
+    height, width = img.shape[:2]
+    scale = min(profile['working_width'] / width, 1.0)
+    if scale < 1.0:
+        img = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+    working_width = img.shape[1]
+    faces = detector.detect(img, int(working_width * profile['min_face']), int(working_width * profile['max_face']),
+                            profile['scale_factor'], profile['min_neighbors'])
+    return [((int(x / scale), int(y / scale), int(w / scale), int(h / scale)), confidence)
+            for (x, y, w, h), confidence in faces]
+
+def process_frame(img_data, reduced=False, all_faces=False):
+    """Decode, detect and encode one encoded frame, timing each stage.
+
+    This is the unit of work run by face pool workers. Returns a dict with
+    ``faces`` (a list of ((x, y, w, h), encoding) in original-frame
+    coordinates, only the largest face unless ``all_faces``), ``decoded``
+    and per-stage ``timings`` in milliseconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+    img = decode_image_bytes(img_data, reduced)
+    timings['decode_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    
+    if img is None:
+        return {'decoded': False, 'faces': [], 'timings': timings}
+    
+    started = time.perf_counter()
+    faces = [box for box, _ in detect_faces(img)]
+    if len(faces) and not all_faces:
+        faces = [max(faces, key=lambda rect: rect[2] * rect[3])]
+    timings['detect_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    
+    started = time.perf_counter()
+    encoder = get_encoder()
+    scale = 2 if reduced else 1
+    encoded = [((x * scale, y * scale, w * scale, h * scale), encoder.encode(img[y:y+h, x:x+w]))
+               for x, y, w, h in faces]
+    timings['encode_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    
+    return {'decoded': True, 'faces': encoded, 'timings': timings}
+
+def detect_face_near(img, box, padding=0.5):
+    """Look for a face in a padded region around its previous box.
+
+    Only the region is scanned, and only at scales close to the previous
+    face size, which is a small fraction of the work of a full-frame
+    detection. ``box`` and the returned box are (x, y, w, h) in ``img``
+    coordinates; returns None if the face wasn't found.
+    """
+    x, y, w, h = box
+    pad_x, pad_y = int(w * padding), int(h * padding)
+    left, top = max(x - pad_x, 0), max(y - pad_y, 0)
+    right, bottom = min(x + w + pad_x, img.shape[1]), min(y + h + pad_y, img.shape[0])
+    size = min(w, h)
+    faces = get_face_detector().detect(img[top:bottom, left:right], int(size * 0.75), int(size * 1.33))
+    if len(faces) == 0:
+        return None
+    fx, fy, fw, fh = max((box for box, _ in faces), key=lambda rect: rect[2] * rect[3])
+    return int(fx) + left, int(fy) + top, int(fw), int(fh)
+
+def process_tracked_frame(img_data, regions, reduced=False, padding=0.5):
+    """Follow already-detected faces into a new frame instead of scanning all of it.
+
+    ``regions`` is a list of (box, encode) with boxes in original-frame
+    coordinates, as returned for the previous frame. Each face is searched
+    for near its previous box and only encoded when ``encode`` is set.
+    Returns a dict like process_frame's whose ``faces`` has one entry per
+    region: (box, encoding or None), or None where the face was lost.
+    """
+    timings = {}
+    started = time.perf_counter()
+    img = decode_image_bytes(img_data, reduced)
+    timings['decode_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    if img is None:
+        return {'decoded': False, 'faces': [], 'timings': timings}
+
+    scale = 2 if reduced else 1
+    started = time.perf_counter()
+    found = [detect_face_near(img, tuple(value // scale for value in box), padding) for box, _ in regions]
+    timings['detect_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    started = time.perf_counter()
+    encoder = get_encoder()
+    faces = []
+    for face, (_, encode) in zip(found, regions):
+        if face is None:
+            faces.append(None)
+            continue
+        x, y, w, h = face
+        encoding = encoder.encode(img[y:y+h, x:x+w]) if encode else None
+        faces.append(((x * scale, y * scale, w * scale, h * scale), encoding))
+    timings['encode_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    return {'decoded': True, 'faces': faces, 'timings': timings}
+
+def face_distances(known_encodings, unknown_encoding, encoder=None, sq_norms=None):
+    """Distances from one encoding to every row of a matrix of known encodings.
+
+    Normalized encoders use cosine distance (1 - dot product); the legacy
+    pixel encoder uses Euclidean distance.
+    """
+    import numpy as np
+    return face_distance_matrix(known_encodings, np.asarray(unknown_encoding).reshape(1, -1),
+                                encoder, sq_norms)[0]
+
+def face_distance_matrix(known_encodings, unknown_encodings, encoder=None, sq_norms=None):
+    """Distances between each unknown encoding (rows) and each known encoding (columns)"""
+    import numpy as np
+    encoder = encoder or get_encoder()
+    known_encodings = np.asarray(known_encodings, dtype=np.float32)
+    unknown_encodings = np.asarray(unknown_encodings, dtype=np.float32)
+
+    if encoder.normalized:
+        return 1 - unknown_encodings @ known_encodings.T
+
+    if sq_norms is None:
+        sq_norms = np.einsum('ij,ij->i', known_encodings, known_encodings)
+
+    # ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2, computed for all pairs at once
+    sq_distances = (sq_norms[None, :] - 2 * (unknown_encodings @ known_encodings.T)
+                    + np.einsum('ij,ij->i', unknown_encodings, unknown_encodings)[:, None])
+    return np.sqrt(np.maximum(sq_distances, 0))
+
+def compare_faces(known_encoding, unknown_encoding, tolerance=None):
     """Compare face encodings and return True if they match"""
+    import numpy as np
     try:
         if known_encoding is None or unknown_encoding is None:
             return False
+        
+        encoder = get_encoder()
+        if tolerance is None:
+            tolerance = encoder.tolerance
             
-        # Convert to numpy arrays if needed
-        if isinstance(known_encoding, list):
-            known_encoding = np.array(known_encoding)
-        if isinstance(unknown_encoding, list):
-            unknown_encoding = np.array(unknown_encoding)
-            
-        # Calculate Euclidean distance between encodings
-        distance = np.linalg.norm(known_encoding - unknown_encoding)
+        distance = float(face_distances(np.asarray(known_encoding).reshape(1, -1), unknown_encoding, encoder)[0])
         
         # Return True if distance is below tolerance threshold
         logger.info(f"Face comparison distance: {distance}")
@@ -89,13 +576,68 @@ def compare_faces(known_encoding, unknown_encoding, tolerance=5000):
         logger.error(f"Error comparing faces: {str(e)}")
         return False
 
-def is_duplicate_face(new_encoding, existing_encodings, tolerance=5000):
-    """Check if a face encoding already exists in the database"""
-    if not new_encoding or not existing_encodings:
-        return False
-    
-    for encoding in existing_encodings:
-        if compare_faces(new_encoding, encoding, tolerance):
-            return True
-    
-    return False
+def find_best_match(known_encodings, unknown_encoding, tolerance=None, sq_norms=None):
+    """Find the closest of many known encodings in one vectorized pass.
+
+    Returns (index, distance) of the best match, or (None, None) if no
+    known encoding is within tolerance.
+    """
+    import numpy as np
+    try:
+        if unknown_encoding is None or len(known_encodings) == 0:
+            return None, None
+
+        encoder = get_encoder()
+        if tolerance is None:
+            tolerance = encoder.tolerance
+
+        distances = face_distances(known_encodings, unknown_encoding, encoder, sq_norms)
+        index = int(np.argmin(distances))
+        distance = float(distances[index])
+
+        logger.info(f"Best face match distance: {distance}")
+        if distance < tolerance:
+            return index, distance
+        return None, None
+    except Exception as e:
+        logger.error(f"Error matching faces: {str(e)}")
+        return None, None
+
+def find_best_matches(known_encodings, unknown_encodings, tolerance=None, sq_norms=None):
+    """Match several faces at once, each known encoding claimed by at most one face.
+
+    Returns a list with one (index, distance) per unknown encoding, or
+    (None, None) where no known encoding is within tolerance.
+    """
+    import numpy as np
+    results = [(None, None)] * len(unknown_encodings)
+    try:
+        if len(unknown_encodings) == 0 or len(known_encodings) == 0:
+            return results
+
+        encoder = get_encoder()
+        if tolerance is None:
+            tolerance = encoder.tolerance
+
+        distances = face_distance_matrix(known_encodings, np.vstack(unknown_encodings), encoder, sq_norms)
+
+        # Greedily assign the closest (face, known) pairs first so two faces
+        # in the same frame can never both claim one student
+        claimed_faces = set()
+        claimed_known = set()
+        for flat in np.argsort(distances, axis=None):
+            face, known = np.unravel_index(flat, distances.shape)
+            distance = float(distances[face, known])
+            if distance >= tolerance:
+                break
+            if face in claimed_faces or known in claimed_known:
+                continue
+            claimed_faces.add(face)
+            claimed_known.add(known)
+            results[face] = (int(known), distance)
+            if len(claimed_faces) == len(results):
+                break
+        return results
+    except Exception as e:
+        logger.error(f"Error matching faces: {str(e)}")
+        return results
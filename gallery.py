@@ -0,0 +1,200 @@
+import os
+import logging
+import threading
+import time
+
+from app import db
+from models import User, Enrollment, LEGACY_FACE_ENCODER
+from face_utils import find_best_match, find_best_matches, get_encoder, configured_encoder_name
+
+logger = logging.getLogger(__name__)
+
+# Galleries are per-process; other workers pick up changes after this many seconds
+GALLERY_TTL = float(os.environ.get('FACE_GALLERY_TTL', 60))
+
+_galleries = {}
+_lock = threading.Lock()
+
+class EncoderMismatch(RuntimeError):
+    pass
+
+def check_face_encoders():
+    """Fail if registered faces were encoded by an encoder other than the configured one.
+
+    Galleries and duplicate checks skip those faces, so their students
+    would silently stop being recognized. This runs at startup, one
+    grouped query over the registered users.
+    """
+    encoder_name = configured_encoder_name()
+    stored_encoder = db.func.coalesce(User.face_encoder, LEGACY_FACE_ENCODER)
+    others = db.session.query(stored_encoder, db.func.count(User.id)).filter(
+        User.face_registered_filter(),
+        stored_encoder != encoder_name
+    ).group_by(stored_encoder).all()
+    if others:
+        counts = ', '.join(f'{count} with {name}' for name, count in others)
+        raise EncoderMismatch(f'FACE_ENCODER selects {encoder_name} but registered faces were encoded '
+                              f'otherwise ({counts}); run "flask reencode-faces" to convert {LEGACY_FACE_ENCODER} '
+                              f'faces, or set FACE_ENCODER to the encoder they were registered with')
+
+class CourseGallery:
+    """Face encodings of a course's enrolled students stacked into one matrix"""
+
+    def __init__(self, course_id, student_ids, usernames, matrix):
+        import numpy as np
+        self.course_id = course_id
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.usernames = list(usernames)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        # Squared row norms are cached so matching is a single matrix-vector product
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def is_expired(self):
+        return time.monotonic() - self.loaded_at > GALLERY_TTL
+
+    def match(self, encoding, tolerance=None):
+        """Return (student_id, username, distance) of the closest face, or (None, None, None)"""
+        index, distance = find_best_match(self.matrix, encoding, tolerance, sq_norms=self.sq_norms)
+        if index is None:
+            return None, None, None
+        return int(self.student_ids[index]), self.usernames[index], distance
+
+    def match_many(self, encodings, tolerance=None):
+        """Match every face of a frame in one matrix operation.
+
+        Returns one (student_id, username, distance) per encoding, with
+        Nones for faces that matched nobody.
+        """
+        results = []
+        for index, distance in find_best_matches(self.matrix, encodings, tolerance, sq_norms=self.sq_norms):
+            if index is None:
+                results.append((None, None, None))
+            else:
+                results.append((int(self.student_ids[index]), self.usernames[index], distance))
+        return results
+
+    def with_face(self, student_id, username, encoding):
+        """Return a copy of this gallery with the student's encoding added or replaced"""
+        import numpy as np
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(1, -1)
+        gallery = self.without_face(student_id)
+        if len(gallery) and gallery.matrix.shape[1] != encoding.shape[1]:
+            logger.warning(f"Encoding size mismatch in course {self.course_id} gallery, skipping patch")
+            return gallery
+        matrix = np.vstack([gallery.matrix, encoding]) if len(gallery) else encoding
+        return CourseGallery(self.course_id,
+                             np.append(gallery.student_ids, student_id),
+                             gallery.usernames + [username],
+                             matrix)
+
+    def without_face(self, student_id):
+        """Return a copy of this gallery with the student's encoding removed"""
+        keep = self.student_ids != student_id
+        if keep.all():
+            return self
+        return CourseGallery(self.course_id,
+                             self.student_ids[keep],
+                             [name for name, k in zip(self.usernames, keep) if k],
+                             self.matrix[keep])
+
+def load_course_gallery(course_id):
+    """Build a course gallery from the database with a single query"""
+    import numpy as np
+    rows = db.session.query(
+        User.id, User.username, User.face_encoding_data, User.face_encoding_dtype,
+        User.face_encoding_dim, User.face_encoding
+    ).join(Enrollment, Enrollment.student_id == User.id).filter(
+        Enrollment.course_id == course_id,
+        User.face_registered_filter(),
+        User.face_encoder_filter(get_encoder().name)
+    ).order_by(User.id).all()
+
+    student_ids = []
+    usernames = []
+    encodings = []
+    for user_id, username, data, dtype, dim, legacy_json in rows:
+        encoding = User.decode_face_encoding(data, dtype, dim, legacy_json)
+        if encodings and len(encoding) != len(encodings[0]):
+            logger.warning(f"Skipping student {user_id}: encoding size does not match gallery")
+            continue
+        student_ids.append(user_id)
+        usernames.append(username)
+        encodings.append(encoding)
+
+    if encodings:
+        matrix = np.vstack(encodings).astype(np.float32)
+    else:
+        matrix = np.empty((0, 0), dtype=np.float32)
+
+    logger.info(f"Loaded face gallery for course {course_id} with {len(student_ids)} students")
+    return CourseGallery(course_id, student_ids, usernames, matrix)
+
+def get_course_gallery(course_id):
+    """Return the cached gallery for a course, loading it if missing or expired"""
+    gallery = _galleries.get(course_id)
+    if gallery is None or gallery.is_expired():
+        gallery = load_course_gallery(course_id)
+        with _lock:
+            _galleries[course_id] = gallery
+    return gallery
+
+def invalidate_course(course_id):
+    """Drop a course gallery so it is rebuilt on next use"""
+    with _lock:
+        _galleries.pop(course_id, None)
+
+def update_student_face(student_id, username, encoding):
+    """Patch cached galleries of the student's courses after a face is registered"""
+    course_ids = [course_id for (course_id,) in db.session.query(Enrollment.course_id).filter_by(
+        student_id=student_id)]
+    with _lock:
+        for course_id in course_ids:
+            gallery = _galleries.get(course_id)
+            if gallery is not None:
+                _galleries[course_id] = gallery.with_face(student_id, username, encoding)
+
+def remove_student_face(student_id):
+    """Remove a student's encoding from every cached gallery"""
+    with _lock:
+        for course_id, gallery in list(_galleries.items()):
+            _galleries[course_id] = gallery.without_face(student_id)
+
+def remove_enrollment(course_id, student_id):
+    """Remove an unenrolled student from the cached gallery of a course"""
+    with _lock:
+        gallery = _galleries.get(course_id)
+        if gallery is not None:
+            _galleries[course_id] = gallery.without_face(student_id)
+
+def recognize_faces(course_gallery, detected):
+    """Match every detected face of a frame against a course gallery.
+
+    ``detected`` is the list of ((x, y, w, h), encoding) produced by
+    face_utils.process_frame. Returns (faces, matched_ids) where faces
+    describes each face's box and the matched student.
+    """
+    matches = course_gallery.match_many([encoding for _, encoding in detected])
+
+    faces = []
+    matched_ids = []
+    for (box, _), (student_id, student_name, distance) in zip(detected, matches):
+        faces.append(describe_face(box, student_id, student_name, distance))
+        if student_id is not None:
+            matched_ids.append(student_id)
+    return faces, matched_ids
+
+def describe_face(box, student_id=None, student_name=None, distance=None):
+    """JSON description of a face's box and the student it matched, if any"""
+    x, y, w, h = box
+    face = {
+        'box': {'x': x, 'y': y, 'width': w, 'height': h},
+        'student': None
+    }
+    if student_id is not None:
+        face['student'] = {'id': student_id, 'name': student_name}
+        face['distance'] = round(distance, 4)
+    return face
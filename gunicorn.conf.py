@@ -0,0 +1,39 @@
+import os
+import time
+
+# gunicorn reads this file from the working directory; command-line flags override it
+
+wsgi_app = 'main:app'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Load the app once in the master so workers fork with it already imported.
+# Off by default because --reload can't pick up code changes when preloading.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+# With preload_app, also load the face detector and encoder in the master so
+# workers share them copy-on-write instead of each loading them on first use
+PRELOAD_FACE_MODELS = os.environ.get('PRELOAD_FACE_MODELS', 'false').lower() in ('1', 'true', 'yes')
+
+def when_ready(server):
+    if server.cfg.preload_app and PRELOAD_FACE_MODELS:
+        import face_utils
+        started = time.perf_counter()
+        face_utils.preload()
+        server.log.info(f'Preloaded face models in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+    if server.cfg.preload_app:
+        from app import app, db
+        import face_utils
+
+        # Connections opened in the master (the schema check) belong to it;
+        # drop them from the worker's pool without closing them
+        with app.app_context():
+            db.engine.dispose(close=False)
+        face_utils.after_fork()
+
+def post_worker_init(worker):
+    worker.log.info(f'Worker {worker.pid} ready in {(time.perf_counter() - worker.forked_at) * 1000:.1f}ms')
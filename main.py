@@ -1,4 +1,13 @@
+import time
+import logging
+
+started = time.perf_counter()
+
 from app import app
 
+# Cold-start cost of this process, also shown by /metrics/startup
+app.config['STARTUP_MS'] = round((time.perf_counter() - started) * 1000, 1)
+logging.getLogger(__name__).info(f"App loaded in {app.config['STARTUP_MS']}ms")
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
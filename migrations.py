@@ -0,0 +1,396 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Column, ForeignKey, Index, UniqueConstraint, Date, DateTime,
+                        Integer, LargeBinary, String, Text, Time, and_, case, func, inspect, insert, or_,
+                        select, text, update)
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
+
+# Rows (or courses, for summaries) handled per transaction by the backfill migrations
+MIGRATION_BATCH_SIZE = 500
+# Key of the PostgreSQL advisory lock held while migrating, so concurrent upgrades run one at a time
+MIGRATION_LOCK_ID = 7355608
+
+schema_metadata = MetaData()
+
+# One row per applied migration; the highest version is the schema version
+schema_version = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# The schema as migration 1 creates it. Migrations only use these frozen
+# definitions, never the models, so they keep working on old databases
+# after the models gain columns; later schema changes are new migrations.
+v1_metadata = MetaData()
+
+v1_user = Table(
+    'user', v1_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(64), unique=True, nullable=False),
+    Column('email', String(120), unique=True, nullable=False),
+    Column('password_hash', String(256), nullable=False),
+    Column('role', String(20), nullable=False),
+    Column('face_encoding', Text),
+    Column('face_encoding_data', LargeBinary),
+    Column('face_encoding_dtype', String(16)),
+    Column('face_encoding_dim', Integer),
+    Column('face_encoding_version', Integer),
+    Column('face_encoder', String(64)),
+    Column('face_registered_at', DateTime),
+    Column('created_at', DateTime),
+)
+
+v1_course = Table(
+    'course', v1_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('code', String(20), nullable=False, unique=True),
+    Column('description', Text),
+    Column('teacher_id', Integer, ForeignKey('user.id'), nullable=False, index=True),
+    Column('created_at', DateTime),
+)
+
+v1_enrollment = Table(
+    'enrollment', v1_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('student_id', Integer, ForeignKey('user.id'), nullable=False),
+    Column('course_id', Integer, ForeignKey('course.id'), nullable=False, index=True),
+    Column('enrolled_at', DateTime),
+    UniqueConstraint('student_id', 'course_id'),
+)
+
+v1_attendance_session = Table(
+    'attendance_session', v1_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('course_id', Integer, ForeignKey('course.id'), nullable=False),
+    Column('date', Date, nullable=False),
+    Column('start_time', Time, nullable=False),
+    Column('end_time', Time),
+    Column('created_at', DateTime),
+    UniqueConstraint('course_id', 'date'),
+)
+
+v1_attendance_record = Table(
+    'attendance_record', v1_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('session_id', Integer, ForeignKey('attendance_session.id'), nullable=False),
+    Column('student_id', Integer, ForeignKey('user.id'), nullable=False),
+    Column('status', String(20)),
+    Column('marked_at', DateTime),
+    Column('marked_by', String(20)),
+    UniqueConstraint('session_id', 'student_id'),
+    Index('ix_attendance_record_student_session', 'student_id', 'session_id', postgresql_include=['status']),
+)
+
+v1_attendance_summary = Table(
+    'attendance_summary', v1_metadata,
+    Column('student_id', Integer, ForeignKey('user.id'), primary_key=True),
+    Column('course_id', Integer, ForeignKey('course.id'), primary_key=True, index=True),
+    Column('present_count', Integer, nullable=False),
+    Column('absent_count', Integer, nullable=False),
+    Column('late_count', Integer, nullable=False),
+    Column('total_sessions', Integer, nullable=False),
+)
+
+# (version, function, transactional) in version order
+MIGRATIONS = []
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+def migration(version, transactional=True):
+    """Register a function(connection) as the migration to ``version``.
+
+    Transactional migrations run in one transaction together with their
+    schema_version row. The others manage their own transactions, for
+    work that can't or shouldn't hold one open (concurrent index builds,
+    batched backfills), and must be safe to run again if interrupted.
+    """
+    def register(function):
+        assert not MIGRATIONS or version > MIGRATIONS[-1][0], 'migrations must be registered in version order'
+        MIGRATIONS.append((version, function, transactional))
+        return function
+    return register
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def current_version(connection):
+    """Highest applied migration, 0 for a database that was never migrated"""
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+def pending_migrations(version):
+    return [(number, function, transactional) for number, function, transactional in MIGRATIONS if number > version]
+
+@contextmanager
+def migration_lock(engine):
+    """Hold a lock that makes concurrent upgrades of one database run one at a time.
+
+    PostgreSQL uses an advisory lock. Other databases use an flock on a
+    file, next to the database for SQLite, so only processes on the same
+    host are serialized, which is what the SQLite fallback allows anyway.
+    """
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_ID})
+            connection.commit()
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_ID})
+                connection.commit()
+        return
+
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and database not in (None, '', ':memory:'):
+        lock_path = database + '.migrate.lock'
+    else:
+        lock_path = os.path.join(tempfile.gettempdir(), f'facetrack-migrate-{engine.dialect.name}.lock')
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def upgrade(engine, target=None):
+    """Apply pending migrations up to ``target`` (default: all). Returns the names applied."""
+    applied = []
+    with migration_lock(engine):
+        schema_metadata.create_all(engine)
+        with engine.connect() as connection:
+            version = current_version(connection)
+
+        for number, function, transactional in pending_migrations(version):
+            if target is not None and number > target:
+                break
+            logger.info(f'Applying migration {number} {function.__name__}')
+            started = time.perf_counter()
+            with engine.connect() as connection:
+                if transactional:
+                    with connection.begin():
+                        function(connection)
+                        record_version(connection, number, function)
+                else:
+                    function(connection)
+                    connection.rollback()
+                    with connection.begin():
+                        record_version(connection, number, function)
+            logger.info(f'Applied migration {number} {function.__name__} in {time.perf_counter() - started:.2f}s')
+            applied.append(function.__name__)
+    return applied
+
+def record_version(connection, number, function):
+    connection.execute(insert(schema_version).values(
+        version=number, name=function.__name__, applied_at=datetime.utcnow()))
+
+def check_schema(engine, auto_upgrade=False):
+    """Verify the database is at the latest schema version, upgrading it if allowed.
+
+    This is the only schema work done at startup: one query when the
+    schema is current.
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version == latest_version():
+        return
+    if version > latest_version():
+        raise SchemaOutOfDate(f'Database schema version {version} is newer than this code ({latest_version()})')
+    if auto_upgrade:
+        upgrade(engine)
+        return
+    raise SchemaOutOfDate(f'Database schema is at version {version}, expected {latest_version()}; '
+                          f'run "flask db-upgrade"')
+
+def add_missing_columns(connection, table_name, columns):
+    """Add columns to a table that was created before they existed"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    binary_type = 'BLOB' if connection.dialect.name == 'sqlite' else 'BYTEA'
+    for name, column_type in columns.items():
+        if name in existing:
+            continue
+        if column_type == 'BYTEA':
+            column_type = binary_type
+        # Nullable columns, or ones with a constant default, are a metadata-only change (no table rewrite)
+        connection.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN {name} {column_type}'))
+        logger.info(f'Added column {table_name}.{name}')
+
+@migration(1)
+def create_tables(connection):
+    """Tables as db.create_all() used to build them at startup; existing tables are left alone"""
+    v1_metadata.create_all(connection)
+
+@migration(2)
+def add_face_encoding_columns(connection):
+    """Binary face encoding storage and the registration flag on pre-existing user tables"""
+    add_missing_columns(connection, v1_user.name, {
+        'face_encoding_data': 'BYTEA',
+        'face_encoding_dtype': 'VARCHAR(16)',
+        'face_encoding_dim': 'INTEGER',
+        'face_encoding_version': 'INTEGER',
+        'face_encoder': 'VARCHAR(64)',
+        'face_registered_at': 'TIMESTAMP',
+    })
+
+@migration(3, transactional=False)
+def flag_face_registrations(connection):
+    """Set face_registered_at for faces registered before the column existed"""
+    users = v1_user
+    while True:
+        batch = select(users.c.id).where(
+            users.c.face_registered_at == None,
+            or_(users.c.face_encoding_data != None, users.c.face_encoding != None)
+        ).limit(MIGRATION_BATCH_SIZE).scalar_subquery()
+        # Their registration time is unknown, account creation is the closest guess
+        result = connection.execute(update(users).where(users.c.id.in_(batch)).values(
+            face_registered_at=func.coalesce(users.c.created_at, func.now())))
+        connection.commit()
+        if result.rowcount < MIGRATION_BATCH_SIZE:
+            break
+
+def legacy_encoding_to_binary(legacy_json):
+    """Storage of a legacy JSON encoding in format version 1: (bytes, dtype name, dimension).
+
+    Frozen copy of what User.encode_face_encoding did when this migration
+    was written. Legacy encodings are pixel values, stored as one byte
+    each when they fit, float32 otherwise.
+    """
+    import numpy as np
+    array = np.asarray(json.loads(legacy_json)).ravel()
+    if array.dtype.kind in 'iub' and array.size and array.min() >= 0 and array.max() <= 255:
+        array = array.astype(np.uint8)
+    else:
+        array = array.astype(np.float32)
+    return array.tobytes(), array.dtype.name, array.size
+
+@migration(4, transactional=False)
+def convert_face_encodings(connection):
+    """Convert legacy JSON face encodings to binary storage.
+
+    Rows are converted in keyset-paginated batches, one transaction
+    each; readers fall back to the JSON column for rows not converted yet.
+    """
+    users = v1_user
+    last_id = 0
+    converted = 0
+    while True:
+        rows = connection.execute(select(users.c.id, users.c.face_encoding).where(
+            users.c.id > last_id,
+            users.c.face_encoding != None,
+            users.c.face_encoding_data == None
+        ).order_by(users.c.id).limit(MIGRATION_BATCH_SIZE)).all()
+        if not rows:
+            break
+
+        last_id = rows[-1].id
+        for user_id, legacy_json in rows:
+            data, dtype, dim = legacy_encoding_to_binary(legacy_json)
+            connection.execute(update(users).where(users.c.id == user_id).values(
+                face_encoding_data=data,
+                face_encoding_dtype=dtype,
+                face_encoding_dim=dim,
+                face_encoding_version=1,
+                # Encodings stored as JSON all came from the pixel encoder
+                face_encoder=func.coalesce(users.c.face_encoder, 'pixel-v1'),
+                face_registered_at=func.coalesce(users.c.face_registered_at, func.now()),
+                face_encoding=None
+            ))
+        connection.commit()
+
+        converted += len(rows)
+        logger.info(f'Converted {converted} face encodings (last id {last_id})')
+
+@migration(5, transactional=False)
+def create_missing_indexes(connection):
+    """Indexes of the version 1 schema that tables created before them are missing.
+
+    On PostgreSQL they are built CONCURRENTLY so the tables stay writable.
+    A concurrent build that failed part way leaves an INVALID index behind
+    under the same name; a rerun drops and rebuilds those.
+    """
+    connection.execution_options(isolation_level='AUTOCOMMIT')
+    inspector = inspect(connection)
+    invalid = invalid_indexes(connection)
+    for table in v1_metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)} - invalid
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            if index.name in invalid:
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+                logger.warning(f'Dropped invalid index {index.name} left by an interrupted build')
+            ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+            if connection.dialect.name == 'postgresql':
+                ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            connection.execute(text(ddl))
+            logger.info(f'Created index {index.name}')
+
+def invalid_indexes(connection):
+    """Names of the indexes PostgreSQL marks invalid in the current schema (none elsewhere)"""
+    if connection.dialect.name != 'postgresql':
+        return set()
+    return set(connection.scalars(text(
+        'SELECT c.relname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE NOT i.indisvalid AND n.nspname = current_schema()'
+    )))
+
+def v1_summary_counts(course_ids):
+    """Each enrollment's attendance counts in the given courses, from the version 1 tables"""
+    records = v1_attendance_record
+    sessions = v1_attendance_session
+    enrollments = v1_enrollment
+
+    def status_count(status):
+        return func.sum(case((records.c.status == status, 1), else_=0)).label(f'{status}_count')
+
+    record_counts = select(
+        sessions.c.course_id, records.c.student_id, *map(status_count, ('present', 'absent', 'late'))
+    ).join(sessions, sessions.c.id == records.c.session_id).where(
+        sessions.c.course_id.in_(course_ids)
+    ).group_by(sessions.c.course_id, records.c.student_id).subquery()
+    session_counts = select(
+        sessions.c.course_id, func.count(sessions.c.id).label('total_sessions')
+    ).where(sessions.c.course_id.in_(course_ids)).group_by(sessions.c.course_id).subquery()
+
+    return select(
+        enrollments.c.student_id, enrollments.c.course_id,
+        *[func.coalesce(record_counts.c[column], 0) for column in ('present_count', 'absent_count', 'late_count')],
+        func.coalesce(session_counts.c.total_sessions, 0)
+    ).outerjoin(record_counts, and_(
+        record_counts.c.course_id == enrollments.c.course_id,
+        record_counts.c.student_id == enrollments.c.student_id
+    )).outerjoin(session_counts, session_counts.c.course_id == enrollments.c.course_id).where(
+        enrollments.c.course_id.in_(course_ids))
+
+@migration(6, transactional=False)
+def fill_attendance_summaries(connection):
+    """Compute the attendance summary of every enrollment, a batch of courses per transaction"""
+    summaries = v1_attendance_summary
+    columns = ['student_id', 'course_id', 'present_count', 'absent_count', 'late_count', 'total_sessions']
+    last_id = 0
+    while True:
+        course_ids = connection.execute(select(v1_course.c.id).where(v1_course.c.id > last_id).order_by(
+            v1_course.c.id).limit(MIGRATION_BATCH_SIZE)).scalars().all()
+        if not course_ids:
+            break
+        last_id = course_ids[-1]
+        connection.execute(summaries.delete().where(summaries.c.course_id.in_(course_ids)))
+        connection.execute(insert(summaries).from_select(columns, v1_summary_counts(course_ids)))
+        connection.commit()
+
+@migration(7)
+def add_course_attendance_version(connection):
+    """Version that keys cached course reports"""
+    add_missing_columns(connection, v1_course.name, {'attendance_version': 'INTEGER NOT NULL DEFAULT 0'})
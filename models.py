@@ -3,13 +3,26 @@ from flask_login import UserMixin
 from datetime import datetime
 import json
 
+# Bump when the binary layout of User.face_encoding_data changes
+FACE_ENCODING_FORMAT_VERSION = 1
+
+# Encoder assumed for encodings stored before the encoder name was recorded
+LEGACY_FACE_ENCODER = 'pixel-v1'
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # 'teacher' or 'student'
-    face_encoding = db.Column(db.Text, nullable=True)  # Store face encoding as JSON string
+    # Encodings are deferred so loading a user (e.g. current_user) doesn't pull them in
+    face_encoding = db.deferred(db.Column(db.Text, nullable=True), group='face_encoding')  # Legacy JSON encoding, see migrations.convert_face_encodings
+    face_encoding_data = db.deferred(db.Column(db.LargeBinary, nullable=True), group='face_encoding')  # Raw encoding bytes
+    face_encoding_dtype = db.Column(db.String(16), nullable=True)
+    face_encoding_dim = db.Column(db.Integer, nullable=True)
+    face_encoding_version = db.Column(db.Integer, nullable=True)
+    face_encoder = db.Column(db.String(64), nullable=True)  # Encoder that produced the encoding
+    face_registered_at = db.Column(db.DateTime, nullable=True)  # Set while a face encoding is stored
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -19,24 +32,69 @@ class User(UserMixin, db.Model):
                                  foreign_keys='Enrollment.student_id')
     
     def has_face_registered(self):
-        return self.face_encoding is not None
+        return self.face_registered_at is not None
+    
+    @classmethod
+    def face_registered_filter(cls):
+        """SQL condition matching users with a face encoding in either storage format"""
+        return db.or_(cls.face_encoding_data != None, cls.face_encoding != None)
+    
+    @classmethod
+    def face_encoder_filter(cls, encoder_name):
+        """SQL condition matching encodings produced by the given encoder"""
+        return db.func.coalesce(cls.face_encoder, LEGACY_FACE_ENCODER) == encoder_name
     
-    def set_face_encoding(self, encoding):
-        """Save face encoding as JSON string"""
+    def get_face_encoder(self):
+        return self.face_encoder or LEGACY_FACE_ENCODER
+    
+    def set_face_encoding(self, encoding, encoder_name=None):
+        """Save face encoding as raw binary with dtype, size and encoder metadata"""
         if encoding is not None:
-            # Handle both numpy arrays (with tolist()) and regular Python lists
-            if hasattr(encoding, 'tolist'):
-                self.face_encoding = json.dumps(encoding.tolist())
-            else:
-                self.face_encoding = json.dumps(encoding)
+            self.face_encoding_data, self.face_encoding_dtype, self.face_encoding_dim = \
+                User.encode_face_encoding(encoding)
+            self.face_encoding_version = FACE_ENCODING_FORMAT_VERSION
+            self.face_encoder = encoder_name or self.get_face_encoder()
+            # Converting or re-encoding an existing face keeps its registration time
+            self.face_registered_at = self.face_registered_at or datetime.utcnow()
         else:
-            self.face_encoding = None
+            self.face_encoding_data = None
+            self.face_encoding_dtype = None
+            self.face_encoding_dim = None
+            self.face_encoding_version = None
+            self.face_encoder = None
+            self.face_registered_at = None
+        # Binary storage supersedes the legacy JSON column
+        self.face_encoding = None
             
     def get_face_encoding(self):
         """Get face encoding as numpy array"""
-        if self.face_encoding:
-            import numpy as np
-            return np.array(json.loads(self.face_encoding))
+        return User.decode_face_encoding(self.face_encoding_data, self.face_encoding_dtype,
+                                         self.face_encoding_dim, self.face_encoding)
+
+    @staticmethod
+    def encode_face_encoding(encoding):
+        """Convert an encoding to (bytes, dtype name, dimension) for storage"""
+        import numpy as np
+        array = np.asarray(encoding).ravel()
+        # Pixel-based encodings fit in one byte per value, everything else is float32
+        if array.dtype.kind in 'iub' and array.size and array.min() >= 0 and array.max() <= 255:
+            array = array.astype(np.uint8)
+        else:
+            array = array.astype(np.float32)
+        return array.tobytes(), array.dtype.name, array.size
+
+    @staticmethod
+    def decode_face_encoding(data, dtype, dim, legacy_json=None):
+        """Decode a stored face encoding without loading the full User row.
+
+        Binary encodings are returned as a read-only view over the stored
+        bytes; rows not yet migrated fall back to the legacy JSON text.
+        """
+        import numpy as np
+        if data is not None:
+            return np.frombuffer(data, dtype=np.dtype(dtype), count=dim)
+        if legacy_json:
+            return np.array(json.loads(legacy_json))
         return None
 
 class Course(db.Model):
@@ -44,7 +102,9 @@ class Course(db.Model):
     name = db.Column(db.String(100), nullable=False)
     code = db.Column(db.String(20), nullable=False, unique=True)
     description = db.Column(db.Text, nullable=True)
-    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Bumped whenever the course's attendance or enrollments change, keys cached reports
+    attendance_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -52,10 +112,15 @@ class Course(db.Model):
                                 cascade='all, delete-orphan')
     attendance_sessions = db.relationship('AttendanceSession', backref='course', lazy=True,
                                         cascade='all, delete-orphan')
+    attendance_summaries = db.relationship('AttendanceSummary', backref='course', lazy=True,
+                                         cascade='all, delete-orphan')
     
     def get_attendance_percentage(self, student_id):
         """Calculate attendance percentage for a student in this course"""
-        from sqlalchemy import func
+        # Use the maintained summary when there is one
+        summary = db.session.get(AttendanceSummary, (student_id, self.id))
+        if summary is not None:
+            return summary.get_attendance_percentage()
         
         # Count all sessions for this course
         total_sessions = AttendanceSession.query.filter_by(course_id=self.id).count()
@@ -75,10 +140,11 @@ class Course(db.Model):
 class Enrollment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False, index=True)
     enrolled_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Define a unique constraint to prevent duplicate enrollment
+    # (its index also serves lookups by student_id)
     __table_args__ = (db.UniqueConstraint('student_id', 'course_id'),)
 
 class AttendanceSession(db.Model):
@@ -104,8 +170,28 @@ class AttendanceRecord(db.Model):
     marked_at = db.Column(db.DateTime, default=datetime.utcnow)
     marked_by = db.Column(db.String(20), default='system')  # 'system', 'manual'
     
-    # Define a unique constraint to prevent duplicate records
-    __table_args__ = (db.UniqueConstraint('session_id', 'student_id'),)
+    # Define a unique constraint to prevent duplicate records; the index serves
+    # per-student lookups and carries status so counts don't visit the table
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'student_id'),
+        db.Index('ix_attendance_record_student_session', 'student_id', 'session_id',
+                 postgresql_include=['status']),
+    )
     
     # Relationship with student
     student = db.relationship('User', foreign_keys=[student_id], backref='attendance_records')
+
+class AttendanceSummary(db.Model):
+    """Per-student attendance counts for a course, kept current as records are written"""
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True, index=True)
+    present_count = db.Column(db.Integer, nullable=False, default=0)
+    absent_count = db.Column(db.Integer, nullable=False, default=0)
+    late_count = db.Column(db.Integer, nullable=False, default=0)
+    total_sessions = db.Column(db.Integer, nullable=False, default=0)
+    
+    def get_attendance_percentage(self):
+        """Same figure as Course.get_attendance_percentage, without the counting queries"""
+        if self.total_sessions == 0:
+            return 0
+        return round((self.present_count / self.total_sessions) * 100, 2)
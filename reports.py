@@ -0,0 +1,182 @@
+import os
+import csv
+import tempfile
+import threading
+from collections import OrderedDict
+from io import StringIO
+from itertools import groupby
+
+from sqlalchemy import and_, select
+
+from app import db
+from models import User, Enrollment, AttendanceSession, AttendanceRecord
+import attendance
+
+# Rows fetched per database round trip while exporting
+EXPORT_BATCH_SIZE = 500
+# Bytes of CSV buffered before a chunk is sent to the client
+CSV_CHUNK_SIZE = 64 * 1024
+# Course reports cached per process; least recently viewed are dropped beyond this many
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', 256))
+
+_course_reports = OrderedDict()
+_course_reports_lock = threading.Lock()
+
+def course_sessions(course_id):
+    """Sessions of a course in report column order"""
+    return AttendanceSession.query.filter_by(course_id=course_id).order_by(
+        AttendanceSession.date).all()
+
+def course_report(course_id):
+    """Per-student attendance counts of a course from one grouped query, best attendance first"""
+    query = attendance.summary_counts([course_id]).add_columns(User.username, User.email).join(
+        User, User.id == Enrollment.student_id).order_by(Enrollment.id)
+
+    students_data = []
+    for row in db.session.execute(query):
+        attendance_percentage = 0
+        if row.total_sessions > 0:
+            attendance_percentage = (row.present_count / row.total_sessions) * 100
+        students_data.append({
+            'student': {'id': row.student_id, 'username': row.username, 'email': row.email},
+            'present_count': row.present_count,
+            'absent_count': row.absent_count,
+            'late_count': row.late_count,
+            'total_sessions': row.total_sessions,
+            'attendance_percentage': round(attendance_percentage, 1)
+        })
+
+    students_data.sort(key=lambda x: x['attendance_percentage'], reverse=True)
+    return students_data
+
+def get_course_report(course):
+    """Return the cached report of a course, recomputing it once the course's attendance_version moves on.
+
+    The version is bumped in the same transaction as every attendance or
+    enrollment change, so a cached report is never served for data that
+    changed since, in this worker or any other.
+    """
+    with _course_reports_lock:
+        cached = _course_reports.get(course.id)
+        if cached is not None and cached[0] == course.attendance_version:
+            _course_reports.move_to_end(course.id)
+            return cached[1]
+
+    students_data = course_report(course.id)
+    with _course_reports_lock:
+        _course_reports[course.id] = (course.attendance_version, students_data)
+        _course_reports.move_to_end(course.id)
+        while len(_course_reports) > REPORT_CACHE_SIZE:
+            _course_reports.popitem(last=False)
+    return students_data
+
+def report_header(sessions):
+    """Header row for the attendance report, one column per session"""
+    header = ['Student ID', 'Student Name', 'Email']
+    for session in sessions:
+        header.append(f'Session {session.date}')
+    header.extend(['Present', 'Absent', 'Late', 'Attendance %'])
+    return header
+
+def report_rows(course_id, sessions):
+    """Yield one row per enrolled student from a single joined query.
+
+    Enrollments are outer-joined to the student's records for this
+    course's sessions and ordered by student, so each student's records
+    arrive together and can be pivoted into session columns without
+    holding more than one student in memory.
+    """
+    columns = {session.id: position for position, session in enumerate(sessions)}
+    course_session_ids = select(AttendanceSession.id).where(AttendanceSession.course_id == course_id)
+
+    query = db.session.query(
+        User.id, User.username, User.email, AttendanceRecord.session_id, AttendanceRecord.status
+    ).select_from(Enrollment).join(
+        User, User.id == Enrollment.student_id
+    ).outerjoin(
+        AttendanceRecord, and_(
+            AttendanceRecord.student_id == Enrollment.student_id,
+            AttendanceRecord.session_id.in_(course_session_ids)
+        )
+    ).filter(Enrollment.course_id == course_id).order_by(User.id)
+
+    for (student_id, username, email), records in groupby(
+            query.yield_per(EXPORT_BATCH_SIZE), key=lambda row: row[:3]):
+        statuses = ['N/A'] * len(sessions)
+        for _, _, _, session_id, status in records:
+            if session_id in columns:
+                statuses[columns[session_id]] = status
+
+        present_count = statuses.count('present')
+        absent_count = statuses.count('absent')
+        late_count = statuses.count('late')
+
+        # Calculate attendance percentage
+        attendance_percentage = 0
+        if sessions:
+            attendance_percentage = (present_count / len(sessions)) * 100
+
+        yield [student_id, username, email, *statuses,
+               present_count, absent_count, late_count, round(attendance_percentage, 1)]
+
+def stream_csv(header, rows):
+    """Yield the report as CSV text in chunks of roughly CSV_CHUNK_SIZE"""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    for row in rows:
+        row[-1] = f'{row[-1]}%'
+        writer.writerow(row)
+        if output.tell() >= CSV_CHUNK_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+def write_xlsx(header, rows):
+    """Write the report to a temporary XLSX file (requires openpyxl)"""
+    from openpyxl import Workbook
+
+    # Write-only mode streams rows to disk instead of building the sheet in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Attendance')
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+def write_parquet(header, rows):
+    """Write the report to a temporary Parquet file (requires pyarrow)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    session_count = len(header) - 7
+    schema = pa.schema(
+        [pa.field(header[0], pa.int64()), pa.field(header[1], pa.string()), pa.field(header[2], pa.string())]
+        + [pa.field(column, pa.string()) for column in header[3:3 + session_count]]
+        + [pa.field(column, pa.int64()) for column in header[-4:-1]]
+        + [pa.field(header[-1], pa.float64())]
+    )
+
+    output = tempfile.TemporaryFile()
+    with pq.ParquetWriter(output, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == EXPORT_BATCH_SIZE:
+                writer.write_table(pa.Table.from_arrays([list(column) for column in zip(*batch)], schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_arrays([list(column) for column in zip(*batch)], schema=schema))
+    output.seek(0)
+    return output
+
+# Binary formats: name -> (writer, mimetype, package needed)
+EXPORT_FORMATS = {
+    'xlsx': (write_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'openpyxl'),
+    'parquet': (write_parquet, 'application/vnd.apache.parquet', 'pyarrow'),
+}
@@ -1,22 +1,36 @@
 import os
+import sys
 import json
 import logging
-import csv
 from datetime import datetime, date, time
 from functools import wraps
-from io import StringIO
+from time import perf_counter
 
-from flask import render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, send_file, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func
+from sqlalchemy import func, case
 
-from app import app, db
-from models import User, Course, Enrollment, AttendanceSession, AttendanceRecord
-from face_utils import extract_face_encoding, compare_faces, is_duplicate_face
+from app import app, db, sock
+from models import User, Course, Enrollment, AttendanceSession, AttendanceRecord, AttendanceSummary
+from face_utils import decode_base64_image, get_encoder, process_frame, load_times
+from face_pool import get_face_pool, PoolSaturated
+import gallery
+import attendance
+import reports
+import user_cache
+import config
+from streaming import RecognitionStream
 
 logger = logging.getLogger(__name__)
 
+# Content types accepted as a raw image request body
+IMAGE_MIMETYPES = {'image/jpeg', 'image/png', 'image/webp', 'application/octet-stream'}
+# Most attendance changes accepted in one batch request
+MAX_BATCH_CHANGES = 1000
+# Most sessions returned by one attendance history request
+MAX_HISTORY_PAGE_SIZE = 100
+
 # Custom decorators for role-based access
 def teacher_required(f):
     @wraps(f)
@@ -36,6 +50,71 @@ def student_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def read_request_image():
+    """Read the encoded bytes of the uploaded frame.
+
+    Accepts a raw image body, a multipart file field named ``image``, or
+    (as a fallback for older clients) a base64 data URL in the JSON
+    ``image`` field or the ``image_data`` form field. Pass ``?reduced=1``
+    to have the frame decoded at half resolution. Returns (bytes, reduced),
+    with bytes None if no image was sent.
+    """
+    reduced = request.args.get('reduced', '0') == '1'
+    
+    if request.mimetype in IMAGE_MIMETYPES:
+        return request.get_data(cache=False), reduced
+    
+    # Browsers send an empty part for a file input nothing was put in
+    upload = request.files.get('image')
+    if upload is not None and upload.filename:
+        img_data = upload.read()
+        if img_data:
+            return img_data, reduced
+    
+    if request.is_json:
+        data = request.get_json(silent=True)
+        image_data = data.get('image') if isinstance(data, dict) else None
+    else:
+        image_data = request.form.get('image_data')
+    
+    if not image_data:
+        return None, reduced
+    
+    return decode_base64_image(image_data), reduced
+
+def process_uploaded_frame(all_faces=False):
+    """Detect and encode faces in the uploaded frame on the face pool.
+
+    Returns (frame, None) on success, or (None, error) where error is a
+    JSON response tuple ready to return from the view: 400 for a missing
+    or undecodable image, 429 with Retry-After when the pool is saturated,
+    503 when processing timed out or failed (including a worker dying).
+    """
+    img_data, reduced = read_request_image()
+    
+    if img_data is None:
+        return None, (jsonify({'success': False, 'message': 'No image data provided'}), 400)
+    
+    try:
+        frame = get_face_pool().run(process_frame, img_data, reduced, all_faces)
+    except PoolSaturated as e:
+        return None, (jsonify({'success': False, 'message': str(e), 'retry_after': e.retry_after}),
+                      429, {'Retry-After': str(e.retry_after)})
+    except TimeoutError:
+        logger.error("Face processing timed out")
+        return None, (jsonify({'success': False, 'message': 'Face processing timed out'}),
+                      503, {'Retry-After': '1'})
+    except Exception as e:
+        # Includes BrokenExecutor when a worker died; the pool restarts itself
+        logger.error(f"Face processing failed: {str(e)}")
+        return None, (jsonify({'success': False, 'message': 'Face processing failed, please retry'}),
+                      503, {'Retry-After': '1'})
+    
+    if not frame['decoded']:
+        return None, (jsonify({'success': False, 'message': 'Could not decode image'}), 400)
+    
+    return frame, None
+
 # Basic Routes
 @app.route('/')
 def index():
@@ -124,6 +203,7 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
+    user_cache.invalidate(current_user.id)
     logout_user()
     flash('You have been logged out', 'info')
     return redirect(url_for('index'))
@@ -138,37 +218,48 @@ def teacher_dashboard():
     
     # Calculate statistics
     total_courses = len(courses)
-    total_students = 0
-    recent_sessions = []
+    course_names = {course.id: course.name for course in courses}
+    
+    # Count enrolled students for all courses in one grouped query
+    enrollment_counts = db.session.query(
+        Enrollment.course_id, func.count(Enrollment.id)
+    ).join(Course).filter(Course.teacher_id == current_user.id).group_by(Enrollment.course_id).all()
+    total_students = sum(count for _, count in enrollment_counts)
+    
+    # Rank each course's sessions by date so the 3 latest per course can be picked in SQL
+    ranked_sessions = db.session.query(
+        AttendanceSession.id.label('session_id'),
+        AttendanceSession.course_id.label('course_id'),
+        AttendanceSession.date.label('date'),
+        func.row_number().over(
+            partition_by=AttendanceSession.course_id,
+            order_by=AttendanceSession.date.desc()
+        ).label('position')
+    ).join(Course).filter(Course.teacher_id == current_user.id).subquery()
+    
+    # Present/total record counts for those sessions via conditional aggregation
+    session_stats = db.session.query(
+        ranked_sessions.c.course_id,
+        ranked_sessions.c.date,
+        func.count(AttendanceRecord.id),
+        func.sum(case((AttendanceRecord.status == 'present', 1), else_=0))
+    ).select_from(ranked_sessions).outerjoin(
+        AttendanceRecord, AttendanceRecord.session_id == ranked_sessions.c.session_id
+    ).filter(ranked_sessions.c.position <= 3).group_by(
+        ranked_sessions.c.session_id, ranked_sessions.c.course_id, ranked_sessions.c.date
+    ).order_by(ranked_sessions.c.date.desc()).limit(5).all()  # Limit to 5 most recent
     
-    for course in courses:
-        # Count enrolled students
-        enrollment_count = Enrollment.query.filter_by(course_id=course.id).count()
-        total_students += enrollment_count
-        
-        # Get recent attendance sessions
-        recent_course_sessions = AttendanceSession.query.filter_by(course_id=course.id).order_by(
-            AttendanceSession.date.desc()).limit(3).all()
+    recent_sessions = []
+    for course_id, session_date, total_records, present_records in session_stats:
+        attendance_rate = 0
+        if total_records > 0:
+            attendance_rate = (present_records / total_records) * 100
         
-        for session in recent_course_sessions:
-            # Calculate attendance rate for this session
-            total_records = AttendanceRecord.query.filter_by(session_id=session.id).count()
-            present_records = AttendanceRecord.query.filter_by(
-                session_id=session.id, status='present').count()
-            
-            attendance_rate = 0
-            if total_records > 0:
-                attendance_rate = (present_records / total_records) * 100
-            
-            recent_sessions.append({
-                'course_name': course.name,
-                'date': session.date,
-                'attendance_rate': round(attendance_rate, 1)
-            })
-    
-    # Sort recent sessions by date (newest first)
-    recent_sessions.sort(key=lambda x: x['date'], reverse=True)
-    recent_sessions = recent_sessions[:5]  # Limit to 5 most recent
+        recent_sessions.append({
+            'course_name': course_names[course_id],
+            'date': session_date,
+            'attendance_rate': round(attendance_rate, 1)
+        })
     
     return render_template('teacher/dashboard.html', 
                           courses=courses,
@@ -240,6 +331,7 @@ def delete_course(course_id):
     # Delete the course
     db.session.delete(course)
     db.session.commit()
+    gallery.invalidate_course(course_id)
     
     flash('Course deleted successfully', 'success')
     return redirect(url_for('course_management'))
@@ -298,15 +390,17 @@ def course_students(course_id):
         flash('You are not authorized to view this course', 'danger')
         return redirect(url_for('course_management'))
     
-    # Get all enrolled students
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
+    # Get all enrolled students along with their user rows
+    enrollments = Enrollment.query.filter_by(course_id=course_id).options(
+        db.joinedload(Enrollment.student)).all()
+    percentages = attendance.attendance_percentages(course_id=course_id)
     
     students_data = []
     for enrollment in enrollments:
-        student = User.query.get(enrollment.student_id)
+        student = enrollment.student
         
         # Calculate attendance percentage
-        attendance_percentage = course.get_attendance_percentage(student.id)
+        attendance_percentage = percentages.get(student.id, 0)
         
         students_data.append({
             'student': student,
@@ -338,7 +432,10 @@ def remove_student(course_id, student_id):
     
     # Delete the enrollment
     db.session.delete(enrollment)
+    AttendanceSummary.query.filter_by(course_id=course_id, student_id=student_id).delete()
+    attendance.bump_attendance_versions([course_id])
     db.session.commit()
+    gallery.remove_enrollment(course_id, student_id)
     
     flash('Student removed from course successfully', 'success')
     return redirect(url_for('course_students', course_id=course_id))
@@ -399,46 +496,68 @@ def new_attendance_session(course_id):
         # Parse date
         session_date = datetime.strptime(session_date, '%Y-%m-%d').date()
         
-        # Check if a session already exists for this date
-        existing_session = AttendanceSession.query.filter_by(
-            course_id=course_id,
-            date=session_date
-        ).first()
+        # Create the session and its absent records in one transaction
+        opened, skipped = attendance.open_sessions([course_id], session_date)
         
-        if existing_session:
+        if skipped:
             flash('An attendance session already exists for this date', 'warning')
             return redirect(url_for('course_attendance', course_id=course_id))
         
-        # Create new session
-        new_session = AttendanceSession(
-            course_id=course_id,
-            date=session_date,
-            start_time=datetime.now().time()
-        )
-        
-        db.session.add(new_session)
-        db.session.commit()
-        
-        # Initialize attendance records for all enrolled students (as absent by default)
-        enrollments = Enrollment.query.filter_by(course_id=course_id).all()
-        for enrollment in enrollments:
-            record = AttendanceRecord(
-                session_id=new_session.id,
-                student_id=enrollment.student_id,
-                status='absent'
-            )
-            db.session.add(record)
-        
         db.session.commit()
         
         flash('New attendance session created', 'success')
-        return redirect(url_for('take_attendance', session_id=new_session.id))
+        return redirect(url_for('take_attendance', session_id=opened[course_id]))
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error creating attendance session: {str(e)}")
         flash('Error creating attendance session', 'danger')
         return redirect(url_for('course_attendance', course_id=course_id))
 
+@app.route('/teacher/sessions/open', methods=['POST'])
+@login_required
+@teacher_required
+def open_attendance_sessions():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Request body must be a JSON object'}), 400
+    course_ids = data.get('course_ids')
+    
+    if not isinstance(course_ids, list) or not course_ids:
+        return jsonify({'success': False, 'message': 'course_ids must be a non-empty list'}), 400
+    
+    try:
+        course_ids = [int(course_id) for course_id in course_ids]
+        session_date = date.today()
+        if data.get('date'):
+            session_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid data'}), 400
+    
+    # Ensure the teacher owns every course
+    owned_ids = {course_id for course_id, in db.session.query(Course.id).filter(
+        Course.id.in_(course_ids), Course.teacher_id == current_user.id)}
+    not_owned = [course_id for course_id in course_ids if course_id not in owned_ids]
+    if not_owned:
+        return jsonify({'success': False, 'message': 'Unauthorized', 'course_ids': not_owned}), 403
+    
+    try:
+        opened, skipped = attendance.open_sessions(course_ids, session_date)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error opening attendance sessions: {str(e)}")
+        return jsonify({'success': False, 'message': 'Error opening attendance sessions'}), 500
+    
+    return jsonify({
+        'success': True,
+        'message': f'{len(opened)} sessions opened, {len(skipped)} already existed',
+        'date': session_date.isoformat(),
+        'sessions': [{'course_id': course_id, 'session_id': session_id}
+                     for course_id, session_id in opened.items()],
+        'skipped': skipped
+    })
+
 @app.route('/teacher/session/<int:session_id>/take-attendance')
 @login_required
 @teacher_required
@@ -451,8 +570,9 @@ def take_attendance(session_id):
         flash('You are not authorized to access this session', 'danger')
         return redirect(url_for('course_management'))
     
-    # Get all enrolled students
-    enrollments = Enrollment.query.filter_by(course_id=course.id).all()
+    # Get all enrolled students along with their user rows
+    enrollments = Enrollment.query.filter_by(course_id=course.id).options(
+        db.joinedload(Enrollment.student)).all()
     
     # Get existing attendance records
     records = AttendanceRecord.query.filter_by(session_id=session_id).all()
@@ -461,7 +581,7 @@ def take_attendance(session_id):
     # Prepare students data
     students_data = []
     for enrollment in enrollments:
-        student = User.query.get(enrollment.student_id)
+        student = enrollment.student
         record = records_dict.get(student.id)
         
         students_data.append({
@@ -491,40 +611,82 @@ def mark_attendance(session_id):
     student_id = data.get('student_id')
     status = data.get('status')
     
+    try:
+        student_id = int(student_id)
+    except (TypeError, ValueError):
+        student_id = None
     if not student_id or status not in ['present', 'absent', 'late']:
         return jsonify({'success': False, 'message': 'Invalid data'}), 400
     
-    # Verify student is enrolled in the course
-    enrollment = Enrollment.query.filter_by(
-        course_id=course.id,
-        student_id=student_id
-    ).first()
+    # Update or create the record if the student is enrolled in the course
+    written = attendance.set_statuses(session_id, course.id, {student_id: status})
     
-    if not enrollment:
+    if student_id not in written:
         return jsonify({'success': False, 'message': 'Student not enrolled in this course'}), 400
     
-    # Update or create attendance record
-    record = AttendanceRecord.query.filter_by(
-        session_id=session_id,
-        student_id=student_id
-    ).first()
+    return jsonify({'success': True, 'message': f'Attendance marked as {status}'})
+
+@app.route('/teacher/session/<int:session_id>/mark-attendance/batch', methods=['POST'])
+@login_required
+@teacher_required
+def batch_mark_attendance(session_id):
+    session = AttendanceSession.query.get_or_404(session_id)
+    course = Course.query.get_or_404(session.course_id)
     
-    if record:
-        record.status = status
-        record.marked_by = 'manual'
-        record.marked_at = datetime.now()
-    else:
-        record = AttendanceRecord(
-            session_id=session_id,
-            student_id=student_id,
-            status=status,
-            marked_by='manual'
-        )
-        db.session.add(record)
+    # Ensure the teacher owns this course
+    if course.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
     
-    db.session.commit()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Request body must be a JSON object'}), 400
+    changes = data.get('changes')
+    
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'success': False, 'message': 'changes must be a non-empty list'}), 400
+    if len(changes) > MAX_BATCH_CHANGES:
+        return jsonify({'success': False,
+                        'message': f'At most {MAX_BATCH_CHANGES} changes per request'}), 400
+    
+    # Validate each change; later changes for the same student win
+    results = []
+    statuses = {}
+    for change in changes:
+        student_id = change.get('student_id') if isinstance(change, dict) else None
+        status = change.get('status') if isinstance(change, dict) else None
+        try:
+            student_id = int(student_id)
+        except (TypeError, ValueError):
+            results.append({'student_id': student_id, 'status': status, 'success': False,
+                            'message': 'Invalid student_id'})
+            continue
+        if status not in attendance.STATUSES:
+            results.append({'student_id': student_id, 'status': status, 'success': False,
+                            'message': 'Invalid status'})
+            continue
+        statuses[student_id] = status
     
-    return jsonify({'success': True, 'message': f'Attendance marked as {status}'})
+    # Check enrollment and write every change with one upsert
+    try:
+        written = attendance.set_statuses(session_id, course.id, statuses)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error marking attendance for session {session_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'Error marking attendance'}), 500
+    
+    for student_id, status in statuses.items():
+        if student_id in written:
+            results.append({'student_id': student_id, 'status': status, 'success': True,
+                            'message': f'Attendance marked as {status}'})
+        else:
+            results.append({'student_id': student_id, 'status': status, 'success': False,
+                            'message': 'Student not enrolled in this course'})
+    
+    return jsonify({
+        'success': len(written) == len(results),
+        'message': f'{len(written)} of {len(results)} changes applied',
+        'results': results
+    }), 200 if written else 400
 
 @app.route('/teacher/session/<int:session_id>/face-recognition', methods=['POST'])
 @login_required
@@ -537,69 +699,121 @@ def face_recognition_attendance(session_id):
     if course.teacher_id != current_user.id:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 403
     
-    data = request.get_json()
-    image_data = data.get('image')
+    # Extract face encoding from image off the request thread
+    frame, error = process_uploaded_frame()
     
-    if not image_data:
-        return jsonify({'success': False, 'message': 'No image data provided'}), 400
+    if error:
+        return error
     
-    # Extract face encoding from image
-    face_encoding = extract_face_encoding(image_data)
+    timings = frame['timings']
     
-    if face_encoding is None:
-        return jsonify({'success': False, 'message': 'No face detected in the image'}), 400
+    if not frame['faces']:
+        return jsonify({'success': False, 'message': 'No face detected in the image',
+                        'timings': timings}), 400
     
-    # Get all enrolled students in this course
-    enrollments = Enrollment.query.filter_by(course_id=course.id).all()
+    _, face_encoding = frame['faces'][0]
     
-    matched_student = None
-    
-    # Compare with each student's face encoding
-    for enrollment in enrollments:
-        student = User.query.get(enrollment.student_id)
-        
-        if not student.has_face_registered():
-            continue
-        
-        student_encoding = student.get_face_encoding()
-        
-        if compare_faces(student_encoding, face_encoding):
-            matched_student = student
-            break
+    # Find the closest enrolled student in the course gallery
+    started = perf_counter()
+    course_gallery = gallery.get_course_gallery(course.id)
+    student_id, student_name, distance = course_gallery.match(face_encoding)
+    timings['match_ms'] = round((perf_counter() - started) * 1000, 2)
     
-    if not matched_student:
-        return jsonify({'success': False, 'message': 'No matching student found'}), 404
+    if student_id is None:
+        return jsonify({'success': False, 'message': 'No matching student found', 'timings': timings}), 404
     
     # Mark attendance for matched student
-    record = AttendanceRecord.query.filter_by(
-        session_id=session_id,
-        student_id=matched_student.id
-    ).first()
-    
-    if record:
-        record.status = 'present'
-        record.marked_by = 'system'
-        record.marked_at = datetime.now()
-    else:
-        record = AttendanceRecord(
-            session_id=session_id,
-            student_id=matched_student.id,
-            status='present',
-            marked_by='system'
-        )
-        db.session.add(record)
-    
-    db.session.commit()
+    attendance.mark_present(session_id, [student_id])
     
     return jsonify({
         'success': True, 
         'message': 'Student recognized and marked present',
         'student': {
-            'id': matched_student.id,
-            'name': matched_student.username
-        }
+            'id': student_id,
+            'name': student_name
+        },
+        'timings': timings
     })
 
+@app.route('/teacher/session/<int:session_id>/face-recognition/batch', methods=['POST'])
+@login_required
+@teacher_required
+def batch_face_recognition_attendance(session_id):
+    session = AttendanceSession.query.get_or_404(session_id)
+    course = Course.query.get_or_404(session.course_id)
+    
+    # Ensure the teacher owns this course
+    if course.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    # Encode every face in the frame off the request thread
+    frame, error = process_uploaded_frame(all_faces=True)
+    
+    if error:
+        return error
+    
+    timings = frame['timings']
+    
+    if not frame['faces']:
+        return jsonify({'success': False, 'message': 'No face detected in the image',
+                        'timings': timings}), 400
+    
+    # Match all faces against the course gallery in one batch
+    started = perf_counter()
+    course_gallery = gallery.get_course_gallery(course.id)
+    faces, matched_ids = gallery.recognize_faces(course_gallery, frame['faces'])
+    timings['match_ms'] = round((perf_counter() - started) * 1000, 2)
+    
+    # Mark every recognized student present in a single transaction
+    attendance.mark_present(session_id, matched_ids)
+    
+    return jsonify({
+        'success': bool(matched_ids),
+        'message': f'{len(matched_ids)} of {len(faces)} faces recognized and marked present',
+        'faces': faces,
+        'timings': timings
+    })
+
+def close_stream(ws, message):
+    """Send an error frame and close the socket with a policy-violation code"""
+    ws.send(json.dumps({'type': 'error', 'message': message}))
+    ws.close(1008, message)
+
+@sock.route('/teacher/session/<int:session_id>/stream')
+def recognition_stream(ws, session_id):
+    # A WebSocket client can't follow the login redirects of the route decorators
+    if not current_user.is_authenticated or current_user.role != 'teacher':
+        return close_stream(ws, 'Access restricted. Teacher privileges required.')
+    
+    session = db.session.get(AttendanceSession, session_id)
+    course = db.session.get(Course, session.course_id) if session else None
+    if course is None:
+        return close_stream(ws, 'Attendance session not found')
+    
+    # Ensure the teacher owns this course
+    if course.teacher_id != current_user.id:
+        return close_stream(ws, 'Unauthorized')
+    
+    # Binary messages are JPEG frames, text messages are control commands
+    stream = RecognitionStream(ws, session_id, course.id,
+                               reduced=request.args.get('reduced', '0') == '1')
+    stream.start()
+    try:
+        while True:
+            message = ws.receive()
+            if isinstance(message, bytes):
+                stream.submit(message)
+                continue
+            # Ignore malformed control messages rather than dropping the stream
+            try:
+                command = json.loads(message) if message else None
+            except ValueError:
+                continue
+            if isinstance(command, dict) and command.get('type') == 'stop':
+                break
+    finally:
+        stream.close()
+
 @app.route('/teacher/course/<int:course_id>/reports')
 @login_required
 @teacher_required
@@ -611,46 +825,11 @@ def course_reports(course_id):
         flash('You are not authorized to view this course', 'danger')
         return redirect(url_for('course_management'))
     
-    # Get all enrolled students
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
-    
     # Get all attendance sessions
-    sessions = AttendanceSession.query.filter_by(course_id=course_id).order_by(
-        AttendanceSession.date).all()
+    sessions = reports.course_sessions(course_id)
     
-    # Prepare data for report
-    students_data = []
-    for enrollment in enrollments:
-        student = User.query.get(enrollment.student_id)
-        
-        # Get attendance records for this student
-        records = AttendanceRecord.query.join(AttendanceSession).filter(
-            AttendanceSession.course_id == course_id,
-            AttendanceRecord.student_id == student.id
-        ).all()
-        
-        # Count present, absent, late
-        present_count = sum(1 for r in records if r.status == 'present')
-        absent_count = sum(1 for r in records if r.status == 'absent')
-        late_count = sum(1 for r in records if r.status == 'late')
-        
-        # Calculate attendance percentage
-        total_sessions = len(sessions)
-        attendance_percentage = 0
-        if total_sessions > 0:
-            attendance_percentage = (present_count / total_sessions) * 100
-        
-        students_data.append({
-            'student': student,
-            'present_count': present_count,
-            'absent_count': absent_count,
-            'late_count': late_count,
-            'total_sessions': total_sessions,
-            'attendance_percentage': round(attendance_percentage, 1)
-        })
-    
-    # Sort by attendance percentage (descending)
-    students_data.sort(key=lambda x: x['attendance_percentage'], reverse=True)
+    # Per-student counts, cached until the course's attendance changes
+    students_data = reports.get_course_report(course)
     
     return render_template('teacher/reports.html', 
                           course=course,
@@ -668,69 +847,37 @@ def export_attendance_report(course_id):
         flash('You are not authorized to access this course', 'danger')
         return redirect(url_for('course_management'))
     
-    # Get all enrolled students
-    enrollments = Enrollment.query.filter_by(course_id=course_id).all()
-    
-    # Get all attendance sessions
-    sessions = AttendanceSession.query.filter_by(course_id=course_id).order_by(
-        AttendanceSession.date).all()
-    
-    # Create CSV data
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Write header row
-    header = ['Student ID', 'Student Name', 'Email']
-    for session in sessions:
-        header.append(f'Session {session.date}')
-    header.extend(['Present', 'Absent', 'Late', 'Attendance %'])
-    
-    writer.writerow(header)
+    export_format = request.args.get('format', 'csv')
+    if export_format != 'csv' and export_format not in reports.EXPORT_FORMATS:
+        flash(f'Unsupported export format: {export_format}', 'danger')
+        return redirect(url_for('course_reports', course_id=course_id))
+    
+    # Get all attendance sessions; each becomes a column of the report
+    sessions = reports.course_sessions(course_id)
+    header = reports.report_header(sessions)
+    rows = reports.report_rows(course_id, sessions)
+    download_name = f"{course.code}_attendance_report.{export_format}"
+    
+    if export_format == 'csv':
+        # Stream rows as they are read so memory stays flat for large courses
+        return Response(
+            stream_with_context(reports.stream_csv(header, rows)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+        )
     
-    # Write data rows
-    for enrollment in enrollments:
-        student = User.query.get(enrollment.student_id)
-        row = [student.id, student.username, student.email]
-        
-        # Get attendance status for each session
-        present_count = 0
-        absent_count = 0
-        late_count = 0
-        
-        for session in sessions:
-            record = AttendanceRecord.query.filter_by(
-                session_id=session.id,
-                student_id=student.id
-            ).first()
-            
-            status = 'N/A'
-            if record:
-                status = record.status
-                if status == 'present':
-                    present_count += 1
-                elif status == 'absent':
-                    absent_count += 1
-                elif status == 'late':
-                    late_count += 1
-            
-            row.append(status)
-        
-        # Calculate attendance percentage
-        total_sessions = len(sessions)
-        attendance_percentage = 0
-        if total_sessions > 0:
-            attendance_percentage = (present_count / total_sessions) * 100
-        
-        row.extend([present_count, absent_count, late_count, f"{round(attendance_percentage, 1)}%"])
-        writer.writerow(row)
+    writer, mimetype, package = reports.EXPORT_FORMATS[export_format]
+    try:
+        output = writer(header, rows)
+    except ImportError:
+        flash(f'{export_format.upper()} export requires the {package} package', 'danger')
+        return redirect(url_for('course_reports', course_id=course_id))
     
-    # Prepare response
-    output.seek(0)
     return send_file(
         output,
         as_attachment=True,
-        download_name=f"{course.code}_attendance_report.csv",
-        mimetype='text/csv'
+        download_name=download_name,
+        mimetype=mimetype
     )
 
 # Student Routes
@@ -738,8 +885,9 @@ def export_attendance_report(course_id):
 @login_required
 @student_required
 def student_dashboard():
-    # Get courses enrolled by this student
-    enrollments = Enrollment.query.filter_by(student_id=current_user.id).all()
+    # Get courses enrolled by this student, loaded with the enrollments in one query
+    enrollments = Enrollment.query.filter_by(student_id=current_user.id).options(
+        db.joinedload(Enrollment.course)).all()
     
     # Calculate statistics
     total_courses = len(enrollments)
@@ -747,12 +895,13 @@ def student_dashboard():
     
     courses_data = []
     overall_attendance = 0
+    percentages = attendance.attendance_percentages(student_id=current_user.id)
     
     for enrollment in enrollments:
-        course = Course.query.get(enrollment.course_id)
+        course = enrollment.course
         
         # Calculate attendance percentage
-        attendance_percentage = course.get_attendance_percentage(current_user.id)
+        attendance_percentage = percentages.get(course.id, 0)
         
         courses_data.append({
             'course': course,
@@ -801,7 +950,9 @@ def enroll_courses():
                 )
                 
                 db.session.add(new_enrollment)
+                attendance.refresh_summaries([int(course_id)], [current_user.id])
                 db.session.commit()
+                gallery.invalidate_course(int(course_id))
                 
                 flash('Successfully enrolled in the course!', 'success')
                 return redirect(url_for('student_dashboard'))
@@ -819,30 +970,57 @@ def enroll_courses():
 @student_required
 def face_registration():
     if request.method == 'POST':
-        image_data = request.form.get('image_data')
+        img_data, reduced = read_request_image()
         
-        if not image_data:
+        if img_data is None:
             flash('No image data provided', 'danger')
         else:
-            # Extract face encoding
-            face_encoding = extract_face_encoding(image_data)
+            # Extract face encoding off the request thread
+            try:
+                frame = get_face_pool().run(process_frame, img_data, reduced)
+                face_encoding = frame['faces'][0][1] if frame['faces'] else None
+            except (PoolSaturated, TimeoutError):
+                frame = None
+                face_encoding = None
+            except Exception as e:
+                # Includes BrokenExecutor when a worker died; the pool restarts itself
+                logger.error(f"Face processing failed for user {current_user.id}: {str(e)}")
+                frame = None
+                face_encoding = None
             
-            if face_encoding is None:
+            if frame is None:
+                flash('The server is busy processing other faces. Please try again in a moment.', 'warning')
+            elif face_encoding is None:
                 flash('No face detected in the image. Please try again.', 'danger')
             else:
-                # Check for duplicate faces
-                students_with_faces = User.query.filter(User.face_encoding != None).all()
-                existing_encodings = [s.get_face_encoding() for s in students_with_faces if s.id != current_user.id]
-                
-                if is_duplicate_face(face_encoding, existing_encodings):
+                # Check for duplicate faces against the campus-wide index (imported
+                # here so workers only load it, and numpy, once faces are registered)
+                import face_index
+                if face_index.is_duplicate_face(face_encoding, exclude_id=current_user.id):
                     flash('This face has already been registered by another user', 'danger')
                 else:
-                    # Save face encoding
-                    current_user.set_face_encoding(face_encoding)
-                    db.session.commit()
-                    
-                    flash('Face registered successfully!', 'success')
-                    return redirect(url_for('student_dashboard'))
+                    # Save face encoding, indexing it first so a saved face is never missing from the index
+                    user = db.session.get(User, current_user.id)
+                    user.set_face_encoding(face_encoding, get_encoder().name)
+                    index = face_index.get_face_index()
+                    try:
+                        index.add(current_user.id, face_encoding)
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.error(f"Error adding face of user {current_user.id} to the face index: {str(e)}")
+                        flash('Your face could not be registered right now. Please try again.', 'danger')
+                    else:
+                        try:
+                            db.session.commit()
+                        except Exception:
+                            db.session.rollback()
+                            index.remove(current_user.id)
+                            raise
+                        user_cache.invalidate(current_user.id)
+                        gallery.update_student_face(current_user.id, current_user.username, face_encoding)
+                        
+                        flash('Face registered successfully!', 'success')
+                        return redirect(url_for('student_dashboard'))
     
     face_registered = current_user.has_face_registered()
     
@@ -852,9 +1030,21 @@ def face_registration():
 @login_required
 @student_required
 def update_face():
-    # Delete existing face encoding
-    current_user.face_encoding = None
+    import face_index
+    
+    # Delete existing face encoding, and only once it is out of the index
+    user = db.session.get(User, current_user.id)
+    user.set_face_encoding(None)
+    try:
+        face_index.get_face_index().remove(current_user.id)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error removing face of user {current_user.id} from the face index: {str(e)}")
+        flash('Your face registration could not be removed right now. Please try again.', 'danger')
+        return redirect(url_for('face_registration'))
     db.session.commit()
+    user_cache.invalidate(current_user.id)
+    gallery.remove_student_face(current_user.id)
     
     flash('Face registration removed. You can register a new face now.', 'info')
     return redirect(url_for('face_registration'))
@@ -863,46 +1053,67 @@ def update_face():
 @login_required
 @student_required
 def student_attendance():
-    # Get courses enrolled by this student
-    enrollments = Enrollment.query.filter_by(student_id=current_user.id).all()
-    
-    attendance_data = []
+    # Latest sessions of every enrolled course from one query; older ones are
+    # loaded on demand from student_attendance_history
+    attendance_data = attendance.student_history(current_user.id)
+    percentages = attendance.attendance_percentages(student_id=current_user.id)
     
-    for enrollment in enrollments:
-        course = Course.query.get(enrollment.course_id)
-        
-        # Get attendance sessions for this course
-        sessions = AttendanceSession.query.filter_by(course_id=course.id).order_by(
-            AttendanceSession.date.desc()).all()
-        
-        sessions_data = []
-        for session in sessions:
-            # Get attendance record for this session
-            record = AttendanceRecord.query.filter_by(
-                session_id=session.id,
-                student_id=current_user.id
-            ).first()
-            
-            status = 'N/A'
-            if record:
-                status = record.status
-            
-            sessions_data.append({
-                'date': session.date,
-                'status': status
-            })
-        
-        # Calculate attendance percentage
-        attendance_percentage = course.get_attendance_percentage(current_user.id)
-        
-        attendance_data.append({
-            'course': course,
-            'sessions': sessions_data,
-            'attendance_percentage': attendance_percentage
-        })
+    for course_data in attendance_data:
+        course_data['attendance_percentage'] = percentages.get(course_data['course']['id'], 0)
     
     return render_template('student/attendance.html', attendance_data=attendance_data)
 
+@app.route('/student/attendance/history')
+@login_required
+@student_required
+def student_attendance_history():
+    # Next page of one course's sessions, older than the 'before' date
+    try:
+        course_id = int(request.args['course_id'])
+        before = request.args.get('before')
+        if before:
+            before = datetime.strptime(before, '%Y-%m-%d').date()
+        limit = int(request.args.get('limit', attendance.HISTORY_PAGE_SIZE))
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid data'}), 400
+    
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    history = attendance.student_history(current_user.id, course_id, before or None, limit)
+    if not history:
+        return jsonify({'success': False, 'message': 'You are not enrolled in this course'}), 404
+    
+    course_data = history[0]
+    return jsonify({
+        'success': True,
+        'course_id': course_id,
+        'sessions': [
+            {'date': session['date'].isoformat(), 'label': session['date'].strftime('%a, %d %b %Y'),
+             'status': session['status']}
+            for session in course_data['sessions']
+        ],
+        'next_before': course_data['next_before'].isoformat() if course_data['next_before'] else None
+    })
+
+@app.route('/metrics/db-pool')
+@login_required
+@teacher_required
+def db_pool_metrics():
+    # Pool state of the worker that served this request
+    return jsonify({'pid': os.getpid(), 'profile': config.APP_ENV, **config.pool_metrics(db.engine)})
+
+@app.route('/metrics/startup')
+@login_required
+@teacher_required
+def startup_metrics():
+    # Cold-start cost of the worker that served this request and what it has loaded since
+    return jsonify({
+        'pid': os.getpid(),
+        'startup_ms': app.config.get('STARTUP_MS'),
+        'face_models_ms': load_times,
+        'opencv_loaded': 'cv2' in sys.modules,
+        'numpy_loaded': 'numpy' in sys.modules
+    })
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
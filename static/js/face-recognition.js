@@ -7,6 +7,9 @@ class FaceRecognition {
         this.webcamHandler = options.webcamHandler || null;
         this.sessionId = options.sessionId || null;
         this.recognitionEndpoint = options.recognitionEndpoint || null;
+        this.batchRecognitionEndpoint = options.batchRecognitionEndpoint || null;
+        this.streamEndpoint = options.streamEndpoint || null;
+        this.socket = null;
         this.recognitionCallback = options.recognitionCallback || null;
         this.recognitionResultElement = options.recognitionResultElement || document.getElementById('recognition-result');
         this.studentNameElement = options.studentNameElement || document.getElementById('student-name');
@@ -15,6 +18,8 @@ class FaceRecognition {
         
         // Bind methods
         this.processImage = this.processImage.bind(this);
+        this.recognizeClassroom = this.recognizeClassroom.bind(this);
+        this.streamFrame = this.streamFrame.bind(this);
         this.showRecognitionResult = this.showRecognitionResult.bind(this);
         this.hideRecognitionResult = this.hideRecognitionResult.bind(this);
         
@@ -28,13 +33,100 @@ class FaceRecognition {
      * Initialize the face recognition system
      */
     init() {
-        // Set up webcam handler callback
-        this.webcamHandler.captureCallback = this.processImage;
+        // Prefer one persistent stream over a request per frame when available
+        if (this.streamEndpoint && 'WebSocket' in window) {
+            this.startStream();
+            this.webcamHandler.captureCallback = this.streamFrame;
+        } else {
+            this.webcamHandler.captureCallback = this.processImage;
+        }
+    }
+    
+    /**
+     * Open the recognition stream for this attendance session
+     */
+    startStream() {
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        this.socket = new WebSocket(`${protocol}//${window.location.host}${this.streamEndpoint}`);
+        
+        this.socket.addEventListener('message', (event) => {
+            const data = JSON.parse(event.data);
+            
+            if (data.type === 'error') {
+                console.error('Recognition stream error:', data.message);
+                return;
+            }
+            
+            // Only newly marked students are reported, each once per stream
+            data.recognized.forEach(student => {
+                this.showRecognitionResult(student);
+                setTimeout(this.hideRecognitionResult, this.processingDelay);
+                
+                if (this.recognitionCallback) {
+                    this.recognitionCallback({ success: true, student: student });
+                }
+            });
+        });
+        
+        // Fall back to one request per frame if the stream goes away
+        this.socket.addEventListener('close', () => {
+            this.socket = null;
+            this.webcamHandler.captureCallback = this.processImage;
+        });
+    }
+    
+    /**
+     * Send a frame over the recognition stream
+     * @param {Blob} imageBlob - JPEG frame
+     */
+    streamFrame(imageBlob) {
+        if (!this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+        
+        // Skip this frame if the previous one hasn't left the browser yet
+        if (this.socket.bufferedAmount > 0) return;
+        
+        this.socket.send(imageBlob);
+    }
+    
+    /**
+     * Close the recognition stream
+     */
+    stopStream() {
+        if (this.socket) {
+            this.socket.send(JSON.stringify({ type: 'stop' }));
+            this.socket.close();
+        }
+    }
+    
+    /**
+     * Build fetch options for an image, sending blobs as a raw JPEG body
+     * @param {Blob|string} imageData - JPEG blob or base64 encoded image data
+     * @returns {Object} Options for fetch()
+     */
+    buildImageRequest(imageData) {
+        if (imageData instanceof Blob) {
+            return {
+                method: 'POST',
+                headers: {
+                    'Content-Type': imageData.type || 'image/jpeg',
+                },
+                body: imageData,
+            };
+        }
+        
+        // Base64 fallback for callers still passing data URLs
+        return {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ image: imageData }),
+        };
     }
     
     /**
      * Process captured image for face recognition
-     * @param {string} imageData - Base64 encoded image data
+     * @param {Blob|string} imageData - JPEG blob or base64 encoded image data
      */
     async processImage(imageData) {
         // Skip if already processing an image
@@ -47,13 +139,7 @@ class FaceRecognition {
             this.webcamHandler.showLoading();
             
             // Send to recognition endpoint
-            const response = await fetch(this.recognitionEndpoint, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ image: imageData }),
-            });
+            const response = await fetch(this.recognitionEndpoint, this.buildImageRequest(imageData));
             
             const data = await response.json();
             
@@ -88,6 +174,42 @@ class FaceRecognition {
         }
     }
     
+    /**
+     * Recognize every face in a single frame and mark them all present
+     * @returns {Object|null} Response with per-face boxes and identities
+     */
+    async recognizeClassroom() {
+        if (!this.batchRecognitionEndpoint || this.isProcessing) return null;
+        
+        const imageBlob = await this.webcamHandler.captureBlob();
+        if (!imageBlob) return null;
+        
+        this.isProcessing = true;
+        this.webcamHandler.showLoading();
+        
+        try {
+            const response = await fetch(this.batchRecognitionEndpoint, this.buildImageRequest(imageBlob));
+            
+            const data = await response.json();
+            
+            // Report each recognized student the same way as single-face recognition
+            if (data.faces && this.recognitionCallback) {
+                data.faces
+                    .filter(face => face.student)
+                    .forEach(face => this.recognitionCallback({ success: true, student: face.student }));
+            }
+            
+            console.log('Classroom recognition result:', data.message);
+            return data;
+        } catch (error) {
+            console.error('Error during classroom recognition:', error);
+            return null;
+        } finally {
+            this.webcamHandler.hideLoading();
+            this.isProcessing = false;
+        }
+    }
+    
     /**
      * Show recognition result
      * @param {Object} student - Student information
@@ -101,8 +101,73 @@ document.addEventListener('DOMContentLoaded', function() {
     if (document.getElementById('webcam')) {
         initializeWebcam();
     }
+    
+    // Save manual attendance changes in one request
+    if (document.getElementById('save-attendance-btn')) {
+        initializeAttendanceEditor();
+    }
 });
 
+/**
+ * Collects status changes from the attendance table and saves them in one batch
+ */
+function initializeAttendanceEditor() {
+    const sessionElement = document.querySelector('[data-session-id]');
+    const saveButton = document.getElementById('save-attendance-btn');
+    if (!sessionElement) return;
+    
+    const pendingChanges = new Map();
+    
+    document.querySelectorAll('.attendance-status-select[data-student-id]').forEach(select => {
+        select.addEventListener('change', function() {
+            pendingChanges.set(Number(this.dataset.studentId), this.value);
+            saveButton.disabled = false;
+        });
+    });
+    
+    saveButton.disabled = true;
+    saveButton.addEventListener('click', async function() {
+        if (pendingChanges.size === 0) return;
+        
+        const changes = Array.from(pendingChanges, ([student_id, status]) => ({ student_id, status }));
+        saveButton.disabled = true;
+        
+        try {
+            const data = await markAttendanceBatch(sessionElement.dataset.sessionId, changes);
+            (data.results || []).forEach(result => {
+                if (result.success) {
+                    pendingChanges.delete(result.student_id);
+                    updateStatusBadge(result.student_id, result.status);
+                }
+            });
+            if (!data.success) {
+                alert(data.message || 'Some attendance changes could not be saved');
+            }
+        } catch (error) {
+            console.error('Error saving attendance:', error);
+            alert('Error saving attendance. Please try again.');
+        } finally {
+            saveButton.disabled = pendingChanges.size === 0;
+        }
+    });
+}
+
+/**
+ * Sends several attendance changes to the server at once
+ * @param {string|number} sessionId - Attendance session ID
+ * @param {Array<{student_id: number, status: string}>} changes - Status changes
+ * @returns {Promise<Object>} Response with a result per change
+ */
+async function markAttendanceBatch(sessionId, changes) {
+    const response = await fetch(`/teacher/session/${sessionId}/mark-attendance/batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ changes })
+    });
+    
+    return response.json();
+}
+
 /**
  * Initializes webcam functionality for attendance pages
  */
@@ -124,6 +189,8 @@ function initializeWebcam() {
         const faceRecognition = new FaceRecognition({
             webcamHandler: webcamHandler,
             recognitionEndpoint: recognitionEndpoint,
+            batchRecognitionEndpoint: `${recognitionEndpoint}/batch`,
+            streamEndpoint: `/teacher/session/${sessionId}/stream`,
             recognitionCallback: updateAttendanceTable
         });
     }
@@ -136,17 +203,23 @@ function initializeWebcam() {
 function updateAttendanceTable(data) {
     if (!data || !data.success) return;
     
-    const studentId = data.student.id;
+    updateStatusBadge(data.student.id, 'present');
+}
+
+/**
+ * Shows a student's attendance status in their table row
+ * @param {number} studentId - Student ID
+ * @param {string} status - 'present', 'absent' or 'late'
+ */
+function updateStatusBadge(studentId, status) {
     const studentRow = document.getElementById(`student-row-${studentId}`);
+    const statusBadge = studentRow ? studentRow.querySelector('.attendance-status') : null;
     
-    if (studentRow) {
-        const statusBadge = studentRow.querySelector('.attendance-status');
-        
-        if (statusBadge) {
-            statusBadge.textContent = 'Present';
-            statusBadge.classList.remove('bg-danger', 'bg-warning');
-            statusBadge.classList.add('bg-success');
-        }
+    if (statusBadge) {
+        const badgeClasses = { present: 'bg-success', absent: 'bg-danger', late: 'bg-warning' };
+        statusBadge.textContent = status.charAt(0).toUpperCase() + status.slice(1);
+        statusBadge.classList.remove('bg-success', 'bg-danger', 'bg-warning');
+        statusBadge.classList.add(badgeClasses[status]);
     }
 }
 
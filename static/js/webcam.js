@@ -18,6 +18,7 @@ class WebcamHandler {
         this.captureInterval = null;
         this.captureCallback = options.captureCallback || null;
         this.captureIntervalTime = options.captureIntervalTime || 1000;
+        this.jpegQuality = options.jpegQuality || 0.85;
         this.autoStart = options.autoStart !== undefined ? options.autoStart : true;
         this.autoCapture = options.autoCapture !== undefined ? options.autoCapture : true;
         
@@ -28,6 +29,7 @@ class WebcamHandler {
         this.startCamera = this.startCamera.bind(this);
         this.stopCamera = this.stopCamera.bind(this);
         this.captureImage = this.captureImage.bind(this);
+        this.captureBlob = this.captureBlob.bind(this);
         this.startCaptureInterval = this.startCaptureInterval.bind(this);
         this.stopCaptureInterval = this.stopCaptureInterval.bind(this);
         
@@ -156,6 +158,22 @@ class WebcamHandler {
         return this.canvasElement.toDataURL('image/jpeg');
     }
     
+    /**
+     * Capture a single frame as a binary JPEG
+     * @returns {Promise<Blob|null>} JPEG blob or null if not streaming
+     */
+    captureBlob() {
+        if (!this.isStreaming) return Promise.resolve(null);
+        
+        // Draw video frame to canvas
+        this.context.drawImage(this.videoElement, 0, 0, this.canvasElement.width, this.canvasElement.height);
+        
+        // Encode straight to JPEG bytes, avoiding the 33% base64 overhead
+        return new Promise(resolve => {
+            this.canvasElement.toBlob(resolve, 'image/jpeg', this.jpegQuality);
+        });
+    }
+    
     /**
      * Start capturing images at intervals
      */
@@ -164,10 +182,10 @@ class WebcamHandler {
         
         if (!this.captureInterval) {
             // Start capture interval
-            this.captureInterval = setInterval(() => {
-                const imageData = this.captureImage();
-                if (imageData && this.captureCallback) {
-                    this.captureCallback(imageData);
+            this.captureInterval = setInterval(async () => {
+                const imageBlob = await this.captureBlob();
+                if (imageBlob && this.captureCallback) {
+                    this.captureCallback(imageBlob);
                 }
             }, this.captureIntervalTime);
             
@@ -217,8 +235,8 @@ class WebcamHandler {
 
 // Example usage:
 // const webcam = new WebcamHandler({
-//     captureCallback: (imageData) => {
-//         // Process the captured image
-//         console.log('Image captured!', imageData.substring(0, 50) + '...');
+//     captureCallback: (imageBlob) => {
+//         // Process the captured JPEG
+//         console.log('Image captured!', imageBlob.size, 'bytes');
 //     }
 // });
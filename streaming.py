@@ -0,0 +1,225 @@
+import os
+import json
+import logging
+import threading
+import time
+
+from app import app
+from face_utils import process_frame, process_tracked_frame
+from face_pool import get_face_pool, PoolSaturated
+import gallery
+import attendance
+
+logger = logging.getLogger(__name__)
+
+# Follow faces found in one frame into the next instead of detecting on every frame
+TRACKING = os.environ.get('FACE_STREAM_TRACKING', 'true').lower() in ('1', 'true', 'yes')
+# Tracked frames between full-frame detections, which pick up faces that entered the scene
+REDETECT_INTERVAL = int(os.environ.get('FACE_TRACK_REDETECT_INTERVAL', 10))
+# Margin searched around a face's previous box, as a fraction of its size
+TRACK_PADDING = float(os.environ.get('FACE_TRACK_PADDING', 0.5))
+# Overlap (intersection over union) for a full detection to continue an existing track
+TRACK_MIN_OVERLAP = 0.3
+
+def box_overlap(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+class FaceTrack:
+    """A face followed across the frames of a stream, and who it was identified as"""
+
+    def __init__(self, box):
+        self.box = box
+        self.student_id = None
+        self.student_name = None
+        self.distance = None
+
+    def identify(self, student_id, student_name, distance):
+        self.student_id = student_id
+        self.student_name = student_name
+        self.distance = distance
+
+class RecognitionStream:
+    """Recognition loop for one attendance session fed over a WebSocket.
+
+    The socket handler only stores incoming frames; a worker thread
+    processes the most recent one. If the worker falls behind, frames
+    that arrived while it was busy are dropped instead of queueing up, so
+    results always describe what the camera sees now.
+
+    With tracking on, a full-frame detection runs only every
+    REDETECT_INTERVAL frames or after a face is lost; in between each
+    face is searched for near its previous box. Faces already identified
+    are not encoded on tracked frames; each full detection matches them
+    again and drops an identity their face no longer matches, so a track
+    that slid onto another person when faces crossed is not trusted.
+    """
+
+    def __init__(self, ws, session_id, course_id, reduced=False):
+        self.ws = ws
+        self.session_id = session_id
+        self.course_id = course_id
+        self.reduced = reduced
+        self.marked_ids = set()
+        self.tracks = []
+        self.frames_since_detection = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self._frame = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._run, name=f'recognition-stream-{session_id}', daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def submit(self, frame):
+        """Replace the pending frame with a newer one"""
+        with self._condition:
+            self.frames_received += 1
+            if self._frame is not None:
+                self.frames_dropped += 1
+            self._frame = frame
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker.join(timeout=5)
+
+    def _next_frame(self):
+        with self._condition:
+            while self._frame is None and not self._closed:
+                self._condition.wait()
+            frame, self._frame = self._frame, None
+            return frame
+
+    def _run(self):
+        with app.app_context():
+            # Load the gallery once for the whole stream
+            course_gallery = gallery.get_course_gallery(self.course_id)
+            while True:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                try:
+                    self._process(course_gallery, frame)
+                except Exception as e:
+                    logger.error(f"Error processing stream frame for session {self.session_id}: {str(e)}")
+
+    def _process(self, course_gallery, frame):
+        started = time.perf_counter()
+        full_detection = not TRACKING or not self.tracks or self.frames_since_detection >= REDETECT_INTERVAL
+        try:
+            if full_detection:
+                result = get_face_pool().run(process_frame, frame, self.reduced, True)
+            else:
+                regions = [(track.box, track.student_id is None) for track in self.tracks]
+                result = get_face_pool().run(process_tracked_frame, frame, regions, self.reduced, TRACK_PADDING)
+        except PoolSaturated:
+            # Other requests have the pool busy; wait for the next frame
+            with self._condition:
+                self.frames_dropped += 1
+            return
+        if not result['decoded']:
+            return
+
+        if full_detection:
+            to_match = self._start_tracks(result['faces'])
+        else:
+            to_match = self._follow_tracks(result['faces'])
+        self._identify(course_gallery, to_match)
+
+        # Students already marked during this stream don't need another write
+        new_ids = [track.student_id for track in self.tracks
+                   if track.student_id is not None and track.student_id not in self.marked_ids]
+        if new_ids:
+            attendance.mark_present(self.session_id, new_ids)
+            self.marked_ids.update(new_ids)
+
+        faces = [gallery.describe_face(track.box, track.student_id, track.student_name, track.distance)
+                 for track in self.tracks]
+        self.ws.send(json.dumps({
+            'type': 'result',
+            'faces': faces,
+            'recognized': [face['student'] for face in faces
+                           if face['student'] and face['student']['id'] in new_ids],
+            'detection': 'full' if full_detection else 'tracked',
+            'frames_received': self.frames_received,
+            'frames_dropped': self.frames_dropped,
+            'processing_ms': round((time.perf_counter() - started) * 1000, 1),
+            'timings': result['timings']
+        }))
+
+    def _start_tracks(self, detected):
+        """Replace the tracks with a full detection's faces, carrying over identities.
+
+        A face continues the previous track it overlaps most. Returns
+        (track, encoding) for every face, so carried-over identities are
+        checked again too.
+        """
+        previous = self.tracks if TRACKING else []
+        self.tracks = []
+        self.frames_since_detection = 0
+        to_match = []
+        for box, encoding in detected:
+            track = max(previous, key=lambda track: box_overlap(track.box, box), default=None)
+            if track is not None and box_overlap(track.box, box) >= TRACK_MIN_OVERLAP:
+                previous.remove(track)
+                track.box = box
+            else:
+                track = FaceTrack(box)
+            self.tracks.append(track)
+            to_match.append((track, encoding))
+        return to_match
+
+    def _follow_tracks(self, followed):
+        """Move the tracks to where process_tracked_frame found their faces.
+
+        Lost tracks are dropped and force a full detection on the next
+        frame. Returns (track, encoding) for the faces that still need matching.
+        """
+        self.frames_since_detection += 1
+        tracks = []
+        unidentified = []
+        for track, face in zip(self.tracks, followed):
+            if face is None:
+                self.frames_since_detection = REDETECT_INTERVAL
+                continue
+            track.box, encoding = face
+            tracks.append(track)
+            if track.student_id is None:
+                unidentified.append((track, encoding))
+        self.tracks = tracks
+        return unidentified
+
+    def _identify(self, course_gallery, faces):
+        """Match the faces' tracks, never giving a student to two tracks.
+
+        An identified track whose face no longer matches its student loses
+        the identity and is matched like a new face.
+        """
+        if not faces:
+            return
+        matches = course_gallery.match_many([encoding for _, encoding in faces])
+        unidentified = []
+        for (track, _), match in zip(faces, matches):
+            if track.student_id is not None and match[0] == track.student_id:
+                track.identify(*match)
+                continue
+            if track.student_id is not None:
+                logger.info(f"Stream for session {self.session_id} lost track of student {track.student_id}")
+                track.identify(None, None, None)
+            unidentified.append((track, match))
+
+        claimed = {track.student_id for track in self.tracks if track.student_id is not None}
+        for track, (student_id, student_name, distance) in unidentified:
+            if student_id is not None and student_id not in claimed:
+                track.identify(student_id, student_name, distance)
+                claimed.add(student_id)
@@ -0,0 +1,26 @@
+"""Shared test setup: points the app at a throwaway database before it is imported.
+
+Uses a SQLite file in a temporary directory by default; set TEST_DATABASE_URL
+to run against an empty PostgreSQL database instead. Import this module
+before app or models.
+"""
+import os
+import tempfile
+
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ['APP_ENV'] = 'test'
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL',
+                                            f"sqlite:///{os.path.join(_tmpdir.name, 'test.db')}")
+
+from sqlalchemy import delete
+
+from app import app, db
+from models import User, Course, Enrollment, AttendanceSession, AttendanceRecord, AttendanceSummary
+
+__all__ = ['app', 'db', 'clear_tables']
+
+def clear_tables():
+    """Delete every row the tests insert, children first"""
+    for model in (AttendanceSummary, AttendanceRecord, AttendanceSession, Enrollment, Course, User):
+        db.session.execute(delete(model))
+    db.session.commit()
@@ -0,0 +1,104 @@
+"""The attendance summary counters stay equal to a recount of the records.
+
+Each write path that maintains the counters incrementally (opening
+sessions with their absent records, marking faces present, editing
+statuses) is followed by the same comparison the verify-attendance-summary
+command makes. The scenario runs once with the dialect's ON CONFLICT insert
+and once with the portable fallback.
+"""
+import unittest
+from datetime import date
+from unittest import mock
+
+from sqlalchemy import delete, insert
+
+from support import app, db, clear_tables
+from models import User, Course, Enrollment, AttendanceSummary
+import attendance
+
+COUNTERS = ('present_count', 'absent_count', 'late_count', 'total_sessions')
+
+class AttendanceSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.session.execute(insert(User), [
+            {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-',
+             'role': 'teacher' if i == 1 else 'student'}
+            for i in range(1, 8)
+        ])
+        db.session.execute(insert(Course), [
+            {'id': 1, 'name': 'Course 1', 'code': 'C1', 'teacher_id': 1},
+            {'id': 2, 'name': 'Course 2', 'code': 'C2', 'teacher_id': 1},
+        ])
+        self.students = [2, 3, 4, 5, 6]
+        db.session.execute(insert(Enrollment), [{'student_id': i, 'course_id': 1} for i in self.students] +
+                                               [{'student_id': 7, 'course_id': 2}])
+        attendance.refresh_summaries()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        clear_tables()
+        db.session.remove()
+        self.app_context.pop()
+
+    def assertSummariesMatchRecords(self):
+        expected = {(row.student_id, row.course_id): tuple(getattr(row, name) for name in COUNTERS)
+                    for row in db.session.execute(attendance.summary_counts())}
+        stored = {(summary.student_id, summary.course_id): tuple(getattr(summary, name) for name in COUNTERS)
+                  for summary in AttendanceSummary.query}
+        self.assertEqual(stored, expected)
+
+    def test_counters_follow_every_write(self):
+        opened, _ = attendance.open_sessions([1, 2], date(2024, 1, 1))
+        db.session.commit()
+        self.assertSummariesMatchRecords()
+
+        first = opened[1]
+        attendance.mark_present(first, [2, 3])
+        self.assertSummariesMatchRecords()
+
+        # Marking an already present student again changes nothing
+        attendance.mark_present(first, [3, 4])
+        self.assertSummariesMatchRecords()
+
+        # Enrolled before the summary table existed: writing their record has to recount it
+        db.session.execute(delete(AttendanceSummary).where(AttendanceSummary.student_id == 6))
+        db.session.commit()
+        attendance.set_statuses(first, 1, {2: 'late', 5: 'present', 6: 'late', 7: 'present'})
+        self.assertSummariesMatchRecords()
+
+        second, _ = attendance.open_sessions([1], date(2024, 1, 2))
+        db.session.commit()
+        attendance.set_statuses(second[1], 1, {student_id: 'present' for student_id in self.students})
+        attendance.set_statuses(second[1], 1, {4: 'absent', 5: 'late'})
+        self.assertSummariesMatchRecords()
+
+    def test_counters_follow_records_inserted_by_marking(self):
+        # A session whose records were never created: marking inserts them
+        opened, _ = attendance.open_sessions([1], date(2024, 1, 1))
+        db.session.execute(delete(attendance.AttendanceRecord).where(
+            attendance.AttendanceRecord.session_id == opened[1]))
+        attendance.refresh_summaries([1])
+        db.session.commit()
+        self.assertSummariesMatchRecords()
+
+        attendance.mark_present(opened[1], [2, 3])
+        self.assertSummariesMatchRecords()
+
+        attendance.set_statuses(opened[1], 1, {3: 'late', 4: 'absent'})
+        self.assertSummariesMatchRecords()
+
+class PortableAttendanceSummaryTest(AttendanceSummaryTest):
+    """The same writes through insert_missing_records_portable, used on databases without ON CONFLICT"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(attendance, 'insert_missing_records', attendance.insert_missing_records_portable)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+if __name__ == '__main__':
+    unittest.main()
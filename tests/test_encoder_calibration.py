@@ -0,0 +1,76 @@
+"""Calibration test for the configured face encoder's match tolerance.
+
+Needs labelled photos of real faces, which are not shipped with the repo:
+point FACE_CALIBRATION_DIR at a directory with one subdirectory of photos
+per person (at least two people with two photos each), taken with the
+cameras the deployment uses. Every pair of faces is compared; pairs of
+the same person must match and pairs of different people must not, at
+the tolerance the app would use (the encoder's default, or
+FACE_RECOGNITION_THRESHOLD). The measured distances are printed so a
+failing run shows which threshold to set.
+
+Skipped when FACE_CALIBRATION_DIR is not set.
+"""
+import os
+import unittest
+
+import face_utils
+
+CALIBRATION_DIR = os.environ.get('FACE_CALIBRATION_DIR')
+# Share of different-person pairs allowed to match, i.e. duplicate registrations wrongly refused
+MAX_FALSE_ACCEPT_RATE = float(os.environ.get('FACE_CALIBRATION_MAX_FAR', 0.001))
+# Share of same-person pairs allowed not to match, i.e. students not recognized
+MAX_FALSE_REJECT_RATE = float(os.environ.get('FACE_CALIBRATION_MAX_FRR', 0.1))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def load_faces(directory):
+    """(person, encoding) for the largest face of every photo, by subdirectory"""
+    faces = []
+    for person in sorted(os.listdir(directory)):
+        person_dir = os.path.join(directory, person)
+        if not os.path.isdir(person_dir):
+            continue
+        for name in sorted(os.listdir(person_dir)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(person_dir, name), 'rb') as f:
+                frame = face_utils.process_frame(f.read())
+            if frame['faces']:
+                faces.append((person, frame['faces'][0][1]))
+    return faces
+
+def rate(distances, predicate):
+    return sum(1 for distance in distances if predicate(distance)) / len(distances)
+
+@unittest.skipUnless(CALIBRATION_DIR, 'FACE_CALIBRATION_DIR is not set')
+class EncoderCalibrationTest(unittest.TestCase):
+
+    def test_tolerance_separates_people(self):
+        import numpy as np
+        encoder = face_utils.get_encoder()
+        faces = load_faces(CALIBRATION_DIR)
+        people = np.array([person for person, _ in faces])
+        distances = face_utils.face_distance_matrix(np.array([encoding for _, encoding in faces]),
+                                                    np.array([encoding for _, encoding in faces]), encoder)
+        pairs = np.triu_indices(len(faces), k=1)
+        same_person = people[pairs[0]] == people[pairs[1]]
+        genuine = distances[pairs][same_person].tolist()
+        impostor = distances[pairs][~same_person].tolist()
+        if not genuine or not impostor:
+            self.skipTest('FACE_CALIBRATION_DIR needs two photos of each of at least two people')
+
+        tolerance = encoder.tolerance
+        false_accept = rate(impostor, lambda distance: distance < tolerance)
+        false_reject = rate(genuine, lambda distance: distance >= tolerance)
+        print(f'\n{encoder.name} on {len(faces)} faces of {len(set(people))} people: '
+              f'same person {np.percentile(genuine, [50, 90, 99]).round(4).tolist()} (p50/p90/p99), '
+              f'different people {np.percentile(impostor, [1, 10, 50]).round(4).tolist()} (p1/p10/p50); '
+              f'tolerance {tolerance}: false accepts {false_accept:.2%}, false rejects {false_reject:.2%}')
+
+        self.assertLessEqual(false_accept, MAX_FALSE_ACCEPT_RATE,
+                             f'tolerance {tolerance} matches different people, lower FACE_RECOGNITION_THRESHOLD')
+        self.assertLessEqual(false_reject, MAX_FALSE_REJECT_RATE,
+                             f'tolerance {tolerance} misses the same person, raise FACE_RECOGNITION_THRESHOLD')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Planner regression test for the hot attendance lookups.
+
+Seeds a realistically sized course load, gathers statistics and checks the
+database's own plan for every query in ``commands.hot_queries`` reads its
+table through an index. Unlike the ``check-query-plans`` command, planner
+settings are left alone, so a plan that only used an index because
+sequential scans were disabled fails here.
+
+Runs against the throwaway database set up by tests/support.py.
+"""
+import random
+import unittest
+from datetime import date, time, timedelta
+
+from sqlalchemy import insert, text
+
+from support import app, db, clear_tables
+from models import User, Course, Enrollment, AttendanceSession, AttendanceRecord, AttendanceSummary
+from commands import hot_queries, query_plan, is_full_scan
+
+TEACHERS = 50
+COURSES = 100
+STUDENTS = 2000
+COURSES_PER_STUDENT = 4
+SESSIONS_PER_COURSE = 30
+STATUSES = ('present', 'present', 'present', 'late', 'absent')
+
+def seed():
+    """Insert teachers, courses, enrollments, sessions, records and summaries"""
+    rng = random.Random(0)
+    db.session.execute(insert(User), [
+        {'id': i, 'username': f'teacher{i}', 'email': f'teacher{i}@example.com',
+         'password_hash': '-', 'role': 'teacher'}
+        for i in range(1, TEACHERS + 1)
+    ])
+    student_ids = range(TEACHERS + 1, TEACHERS + STUDENTS + 1)
+    db.session.execute(insert(User), [
+        {'id': i, 'username': f'student{i}', 'email': f'student{i}@example.com',
+         'password_hash': '-', 'role': 'student'}
+        for i in student_ids
+    ])
+    db.session.execute(insert(Course), [
+        {'id': i, 'name': f'Course {i}', 'code': f'C{i:04d}', 'teacher_id': (i - 1) % TEACHERS + 1}
+        for i in range(1, COURSES + 1)
+    ])
+
+    course_students = {course_id: [] for course_id in range(1, COURSES + 1)}
+    for student_id in student_ids:
+        for course_id in rng.sample(range(1, COURSES + 1), COURSES_PER_STUDENT):
+            course_students[course_id].append(student_id)
+    db.session.execute(insert(Enrollment), [
+        {'student_id': student_id, 'course_id': course_id}
+        for course_id, students in course_students.items() for student_id in students
+    ])
+
+    sessions = []
+    records = []
+    summaries = []
+    for course_id, students in course_students.items():
+        counts = {student_id: dict.fromkeys(('present', 'absent', 'late'), 0) for student_id in students}
+        for day in range(SESSIONS_PER_COURSE):
+            session_id = len(sessions) + 1
+            sessions.append({'id': session_id, 'course_id': course_id,
+                             'date': date(2024, 1, 1) + timedelta(days=day), 'start_time': time(9)})
+            for student_id in students:
+                status = rng.choice(STATUSES)
+                counts[student_id][status] += 1
+                records.append({'session_id': session_id, 'student_id': student_id, 'status': status})
+        summaries.extend({'student_id': student_id, 'course_id': course_id,
+                          'present_count': count['present'], 'absent_count': count['absent'],
+                          'late_count': count['late'], 'total_sessions': SESSIONS_PER_COURSE}
+                         for student_id, count in counts.items())
+    db.session.execute(insert(AttendanceSession), sessions)
+    db.session.execute(insert(AttendanceRecord), records)
+    db.session.execute(insert(AttendanceSummary), summaries)
+    db.session.commit()
+
+class HotQueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app_context = app.app_context()
+        cls.app_context.push()
+        seed()
+        with db.engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
+
+    @classmethod
+    def tearDownClass(cls):
+        clear_tables()
+        db.session.remove()
+        cls.app_context.pop()
+
+    def test_hot_queries_use_an_index(self):
+        with db.engine.connect() as connection:
+            for description, table_name, statement in hot_queries():
+                with self.subTest(description):
+                    plan = query_plan(connection, statement)
+                    self.assertFalse(is_full_scan(plan, table_name),
+                                     f'{table_name} is scanned:\n' + '\n'.join(plan))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+from app import db
+from models import User
+
+# Cached identities are per-process; other workers see changes after this many seconds
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+# Least recently used identities are dropped beyond this many users
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+
+_users = OrderedDict()
+_lock = threading.Lock()
+
+class CachedUser(UserMixin):
+    """Identity of a logged-in user, detached from any database session.
+
+    Used as current_user so authenticated requests don't load the user
+    row. Routes that change the user load the User model themselves and
+    call invalidate() afterwards.
+    """
+
+    def __init__(self, id, username, role, face_registered):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.face_registered = face_registered
+        self.loaded_at = time.monotonic()
+
+    def is_expired(self):
+        return time.monotonic() - self.loaded_at > USER_CACHE_TTL
+
+    def has_face_registered(self):
+        return self.face_registered
+
+def load_cached_user(user_id):
+    """Fetch only the identity columns of a user"""
+    row = db.session.query(
+        User.id, User.username, User.role, User.face_registered_at
+    ).filter(User.id == user_id).first()
+    if row is None:
+        return None
+    return CachedUser(row.id, row.username, row.role, row.face_registered_at is not None)
+
+def get_user(user_id):
+    """Return the cached identity for a user id, loading it on a miss or after the TTL"""
+    with _lock:
+        user = _users.get(user_id)
+        if user is not None and not user.is_expired():
+            _users.move_to_end(user_id)
+            return user
+
+    user = load_cached_user(user_id)
+    with _lock:
+        if user is None:
+            _users.pop(user_id, None)
+            return None
+        _users[user_id] = user
+        _users.move_to_end(user_id)
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+    return user
+
+def invalidate(user_id):
+    """Drop a user's cached identity after their row changes"""
+    with _lock:
+        _users.pop(user_id, None)